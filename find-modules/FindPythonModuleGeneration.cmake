@@ -114,7 +114,7 @@ function(ecm_generate_python_binding
     modulename_keyword modulename_value
     )
 
-    cmake_parse_arguments(GPB "" "RULES_FILE" "SIP_DEPENDS;SIP_INCLUDES;HEADERS"  ${ARGN})
+    cmake_parse_arguments(GPB "SNAPSHOTS" "RULES_FILE;JOBS" "SIP_DEPENDS;SIP_INCLUDES;HEADERS;PCH_PRELUDE"  ${ARGN})
 
     file(WRITE "${CMAKE_CURRENT_BINARY_DIR}/sip/${pythonnamespace_value}/${modulename_value}/${modulename_value}mod.sip"
           "
@@ -124,7 +124,7 @@ function(ecm_generate_python_binding
 #pragma GCC visibility push(default)
 %End\n\n")
 
-    set(generator_depends "${GPB_MODULE_DIR}/sip_generator.py" "${GPB_MODULE_DIR}/rules_engine.py" "${GPB_MODULE_DIR}/FindPythonModuleGeneration.cmake")
+    set(generator_depends "${GPB_MODULE_DIR}/sip_generator.py" "${GPB_MODULE_DIR}/rules_engine.py" "${GPB_MODULE_DIR}/ast_snapshot.py" "${GPB_MODULE_DIR}/FindPythonModuleGeneration.cmake")
 
     foreach(dep ${GPB_SIP_DEPENDS})
         if (IS_ABSOLUTE ${dep})
@@ -135,13 +135,31 @@ function(ecm_generate_python_binding
     endforeach()
 
     set(sip_files)
-    set(commands)
+    set(hdr_files)
+    set(manifest_contents)
 
     if (GPB_RULES_FILE)
       set(rules_arg --project-rules ${GPB_RULES_FILE})
       list(APPEND generator_depends ${GPB_RULES_FILE})
     endif()
 
+    if (GPB_JOBS)
+      set(jobs_arg -j ${GPB_JOBS})
+    endif()
+
+    if (GPB_PCH_PRELUDE)
+      string(REPLACE ";" "," pch_prelude "${GPB_PCH_PRELUDE}")
+      set(pch_arg --pch-prelude "${pch_prelude}"
+        --pch-file "${CMAKE_CURRENT_BINARY_DIR}/pybuild/${pythonnamespace_value}/${modulename_value}/prelude.pch")
+    endif()
+
+    #
+    # Snapshots are opt-in, since rules run against a snapshot only see part of the clang.cindex API.
+    #
+    if (GPB_SNAPSHOTS)
+      set(snapshot_arg --snapshot-dir "${CMAKE_CURRENT_BINARY_DIR}/pybuild/${pythonnamespace_value}/${modulename_value}/snapshots")
+    endif()
+
     foreach(hdr ${GPB_HEADERS})
         if (${hdr} MATCHES ".*.h$")
           continue()
@@ -157,20 +175,63 @@ function(ecm_generate_python_binding
 
         set(sip_file "${CMAKE_CURRENT_BINARY_DIR}/sip/${pythonnamespace_value}/${modulename_value}/${hdr}.sip")
         list(APPEND sip_files ${sip_file})
-
-        add_custom_command(OUTPUT ${sip_file}
-            COMMAND python ${GPB_MODULE_DIR}/sip_generator.py
-              ${rules_arg}
-              --includes $<JOIN:$<TARGET_PROPERTY:${target_value},INTERFACE_INCLUDE_DIRECTORIES>,,>
-              --include_filename "${hdr_filename}"
-              "${hdr_file}" > "${sip_file}"
-            DEPENDS ${hdr_file} ${generator_depends}
-        )
+        list(APPEND hdr_files ${hdr_file})
+        set(manifest_contents "${manifest_contents}${hdr_file};${hdr_filename};${sip_file}\n")
 
         file(APPEND "${CMAKE_CURRENT_BINARY_DIR}/sip/${pythonnamespace_value}/${modulename_value}/${modulename_value}mod.sip"
           "%Include ${hdr}.sip\n")
     endforeach()
 
+    #
+    # All the headers of the module are generated by a single run of the generator. Only touch the manifest when its
+    # contents change so that reconfiguring does not force the generation to be rerun.
+    #
+    set(manifest "${CMAKE_CURRENT_BINARY_DIR}/pybuild/${pythonnamespace_value}/${modulename_value}/${modulename_value}.manifest")
+    file(WRITE "${manifest}.tmp" "${manifest_contents}")
+    configure_file("${manifest}.tmp" "${manifest}" COPYONLY)
+
+    #
+    # Where the CMake generator supports it, have the generator report the headers actually read, so that a change to
+    # any header they include reruns the generation.
+    #
+    if (CMAKE_GENERATOR MATCHES "Ninja" AND NOT CMAKE_VERSION VERSION_LESS 3.7)
+      set(depfile_arg --depfile "${manifest}.d")
+      set(depfile_option DEPFILE "${manifest}.d")
+      #
+      # Unless CMake rewrites the depfile for ninja (policy CMP0116), the target must be named as it is in
+      # build.ninja, relative to the top of the build tree. Otherwise ninja reruns the generation in every build.
+      #
+      set(depfile_policy OLD)
+      if (POLICY CMP0116)
+        cmake_policy(GET CMP0116 depfile_policy)
+      endif()
+      if (NOT depfile_policy STREQUAL "NEW" AND sip_files)
+        list(GET sip_files 0 depfile_target)
+        file(RELATIVE_PATH depfile_target "${CMAKE_BINARY_DIR}" "${depfile_target}")
+        list(APPEND depfile_arg --depfile-target "${depfile_target}")
+      endif()
+    elseif (CMAKE_GENERATOR MATCHES "Makefiles" AND NOT CMAKE_VERSION VERSION_LESS 3.20)
+      set(depfile_arg --depfile "${manifest}.d")
+      set(depfile_option DEPFILE "${manifest}.d")
+    endif()
+
+    #
+    # Rules which match but change nothing are only reported when the generator is run with --verbose, or with
+    # --trace-rule for the rules of interest.
+    #
+    add_custom_command(OUTPUT ${sip_files}
+        COMMAND python ${GPB_MODULE_DIR}/sip_generator.py
+          ${rules_arg}
+          ${jobs_arg}
+          ${pch_arg}
+          ${depfile_arg}
+          ${snapshot_arg}
+          --includes $<JOIN:$<TARGET_PROPERTY:${target_value},INTERFACE_INCLUDE_DIRECTORIES>,,>
+          --batch "${manifest}"
+        DEPENDS ${hdr_files} ${generator_depends} "${manifest}"
+        ${depfile_option}
+    )
+
     file(WRITE "${CMAKE_CURRENT_BINARY_DIR}/pybuild/${pythonnamespace_value}/${modulename_value}/module.sbf"
         "
 target = ${modulename_value}
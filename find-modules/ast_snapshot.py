@@ -0,0 +1,506 @@
+#!/usr/bin/env python
+#
+# Copyright 2026 by agent (agent@local)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301  USA.
+#
+"""
+Snapshots of the parts of a parsed header which the SIP generator uses.
+
+A snapshot records the cursors, types, extents and default values the generator reads from libclang, and restores them
+as objects with the same attributes and methods as the clang.cindex ones. Replaying a snapshot only needs the pure
+Python enumerations from clang.cindex, and not libclang itself, so that changes to the rules can be tried out without
+parsing any C++.
+"""
+from __future__ import print_function
+import collections
+import ctypes
+import gettext
+import logging
+import os
+import tempfile
+import zlib
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from clang import cindex
+from clang.cindex import AccessSpecifier, CursorKind, StorageClass, TypeKind
+
+
+logger = logging.getLogger(__name__)
+gettext.install(__name__)
+
+# Keep PyCharm happy.
+_ = _
+
+#
+# Bump this whenever the layout of the tables changes.
+#
+FORMAT = 2
+
+FUNCTION_KINDS = [CursorKind.CXX_METHOD, CursorKind.FUNCTION_DECL, CursorKind.FUNCTION_TEMPLATE,
+                  CursorKind.CONSTRUCTOR, CursorKind.DESTRUCTOR, CursorKind.CONVERSION_FUNCTION]
+#
+# The generator only processes the members of these which are in the header itself, so anything else they contain
+# is recorded as a stub.
+#
+CONTAINER_KINDS = [CursorKind.TRANSLATION_UNIT, CursorKind.NAMESPACE, CursorKind.CLASS_DECL,
+                   CursorKind.CLASS_TEMPLATE, CursorKind.CLASS_TEMPLATE_PARTIAL_SPECIALIZATION,
+                   CursorKind.STRUCT_DECL, CursorKind.UNION_DECL]
+TYPEDEF_KINDS = [CursorKind.TYPEDEF_DECL, CursorKind.TYPE_ALIAS_DECL]
+
+CONST_METHOD = 1
+STATIC_METHOD = 2
+VIRTUAL_METHOD = 4
+PURE_VIRTUAL_METHOD = 8
+#
+# Recorded for the members of containers, so that replaying a snapshot skips the same ones as walking the translation
+# unit did. See main_file_filter().
+#
+IN_MAIN_FILE = 16
+
+
+class SnapshotFile(collections.namedtuple("SnapshotFile", ["name"])):
+    __slots__ = ()
+
+    def __str__(self):
+        return self.name
+
+
+SnapshotInclusion = collections.namedtuple("SnapshotInclusion", ["source", "include", "location", "depth"])
+
+
+class SnapshotLocation(object):
+    __slots__ = ["file", "line", "column", "offset"]
+
+    def __init__(self, file, line, column, offset):
+        self.file = file
+        self.line = line
+        self.column = column
+        self.offset = offset
+
+
+class SnapshotExtent(object):
+    __slots__ = ["start", "end"]
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+
+class SnapshotDiagnostic(object):
+    __slots__ = ["severity", "location", "spelling"]
+
+    def __init__(self, severity, location, spelling):
+        self.severity = severity
+        self.location = location
+        self.spelling = spelling
+
+
+def _unrecorded(snapshot, name):
+    """
+    Report the use of a part of the clang.cindex API which snapshots do not record.
+    """
+    return AttributeError(_("{} has no attribute {}: snapshots only record part of the clang.cindex API, see "
+                            "RuleSet").format(type(snapshot).__name__, name))
+
+
+class SnapshotType(object):
+    """
+    The recorded parts of a clang.cindex.Type.
+    """
+    __slots__ = ["kind", "spelling", "_canonical", "_declaration"]
+
+    def __init__(self, kind, spelling):
+        self.kind = kind
+        self.spelling = spelling
+        self._canonical = self
+        self._declaration = None
+
+    def get_canonical(self):
+        return self._canonical
+
+    def get_declaration(self):
+        return self._declaration
+
+    def __getattr__(self, name):
+        raise _unrecorded(self, name)
+
+
+class SnapshotCursor(object):
+    """
+    The recorded parts of a clang.cindex.Cursor. Stubs, for the members of a container which are not in the header and
+    for the expressions of default values, only have their kind and location.
+
+    Cursors compare by identity, which matches libclang since each cursor is only restored once.
+    """
+    __slots__ = ["kind", "spelling", "displayname", "access_specifier", "storage_class", "location", "extent",
+                 "semantic_parent", "type", "result_type", "underlying_typedef_type", "translation_unit",
+                 "default_value", "_flags", "_children"]
+
+    def get_children(self):
+        return iter(self._children)
+
+    def is_const_method(self):
+        return bool(self._flags & CONST_METHOD)
+
+    def is_static_method(self):
+        return bool(self._flags & STATIC_METHOD)
+
+    def is_virtual_method(self):
+        return bool(self._flags & VIRTUAL_METHOD)
+
+    def is_pure_virtual_method(self):
+        return bool(self._flags & PURE_VIRTUAL_METHOD)
+
+    def __getattr__(self, name):
+        raise _unrecorded(self, name)
+
+
+class SnapshotTU(object):
+    """
+    The recorded parts of a clang.cindex.TranslationUnit, plus the files read to parse it.
+    """
+    __slots__ = ["spelling", "cursor", "diagnostics", "dependencies", "_includes"]
+
+    def get_includes(self):
+        return iter(self._includes)
+
+
+def get_children(cursor):
+    """
+    Get the children of a cursor. Those of a clang.cindex.Cursor are only fetched from libclang the first time, so
+    that walking them again finds the same cursor objects, along with the spellings, extents, types and so on which
+    clang.cindex caches on each of them.
+
+    :param cursor:              A clang.cindex.Cursor or SnapshotCursor.
+    :return:                    A list of the children.
+    """
+    if isinstance(cursor, SnapshotCursor):
+        return cursor._children
+    try:
+        return cursor._cached_children
+    except AttributeError:
+        children = cursor._cached_children = list(cursor.get_children())
+        return children
+
+
+def main_file_filter(tu):
+    """
+    Get a test for whether a cursor is in the main file of a translation unit, rather than in an included header. A
+    cursor produced by a macro is in the file where the macro was used, not where it was defined.
+
+    For libclang, comparing the file of the cursor's expansion location with the main file takes one call, rather than
+    the several needed to fetch the name of the cursor's file and compare it with the main file's. That matters for
+    the top level of a translation unit, where most of the cursors usually come from the included headers.
+
+    :param tu:                  A clang.cindex.TranslationUnit or SnapshotTU.
+    :return:                    A function taking a cursor and returning whether it is in the main file.
+    """
+    if isinstance(tu, SnapshotTU):
+        return lambda cursor: bool(cursor._flags & IN_MAIN_FILE)
+    main_file = tu.spelling
+
+    def compare_names(cursor):
+        file = cursor.location.file
+        return file is not None and file.name == main_file
+
+    get_expansion_location = getattr(cindex.conf.lib, "clang_getExpansionLocation", None)
+    main_file_id = ctypes.cast(cindex.conf.lib.clang_getFile(tu, main_file), ctypes.c_void_p).value
+    if get_expansion_location is None or not main_file_id:
+        return compare_names
+    get_expansion_location.argtypes = [cindex.SourceLocation, ctypes.POINTER(ctypes.c_void_p), ctypes.c_void_p,
+                                       ctypes.c_void_p, ctypes.c_void_p]
+    get_expansion_location.restype = None
+    file_id = ctypes.c_void_p()
+    file_id_p = ctypes.byref(file_id)
+
+    def compare_files(cursor):
+        get_expansion_location(cursor.location, file_id_p, None, None, None)
+        return file_id.value == main_file_id
+    return compare_files
+
+
+class _Recorder(object):
+    """
+    Flatten a translation unit into tables of tuples which refer to each other by index, so that the snapshot is
+    compact and quick to pickle however deep the AST is.
+    """
+    def __init__(self, tu, parameter_default):
+        self.tu = tu
+        self.in_main_file = main_file_filter(tu)
+        self.parameter_default = parameter_default
+        self.files = []
+        self.file_indices = {}
+        self.types = []
+        self.type_indices = {}
+        self.cursors = []
+        self.cursor_indices = {}
+        #
+        # (type index, declaration cursor) pairs, resolved once all the cursors in the header are known.
+        #
+        self.declarations = []
+
+    def _file(self, file):
+        if file is None:
+            return -1
+        name = file.name
+        index = self.file_indices.get(name)
+        if index is None:
+            index = self.file_indices[name] = len(self.files)
+            self.files.append(name)
+        return index
+
+    def _location(self, location):
+        return self._file(location.file), location.line, location.column, location.offset
+
+    def _type(self, type):
+        kind = type.kind
+        if kind == TypeKind.INVALID:
+            return -1
+        canonical = type.get_canonical()
+        declaration = type.get_declaration()
+        key = (kind.value, type.spelling, canonical.kind.value, canonical.spelling, declaration.hash)
+        index = self.type_indices.get(key)
+        if index is None:
+            index = self.type_indices[key] = len(self.types)
+            self.types.append([kind.value, key[1], index, -1])
+            if (canonical.kind, canonical.spelling) != (kind, key[1]):
+                self.types[index][2] = self._type(canonical)
+            if declaration.kind != CursorKind.NO_DECL_FOUND:
+                self.declarations.append((index, declaration))
+        return index
+
+    def _stub(self, cursor):
+        index = len(self.cursors)
+        self.cursors.append((cursor.kind.value, None, None, 0, 0, self._location(cursor.location), None, -1, -1, -1,
+                             -1, 0, None, ()))
+        return index
+
+    def _semantic_parent(self, index, cursor, parent=None, parent_index=-1):
+        """
+        The semantic parent of a declaration is normally the lexical one. Others are resolved later.
+        """
+        semantic_parent = cursor.semantic_parent
+        if semantic_parent is None:
+            return -1
+        if parent is not None and semantic_parent == parent:
+            return parent_index
+        self.parents.append((index, semantic_parent))
+        return -1
+
+    def _cursor(self, cursor, parent=None, parent_index=-1, default=None, flags=0):
+        index = len(self.cursors)
+        self.cursors.append(None)
+        kind = cursor.kind
+        extent = cursor.extent
+        semantic_parent = -1
+        result_type = -1
+        underlying = -1
+        if kind.is_declaration() or kind == CursorKind.TRANSLATION_UNIT:
+            #
+            # Only declarations can be referred to from elsewhere.
+            #
+            self.cursor_indices[cursor] = index
+            semantic_parent = self._semantic_parent(index, cursor, parent, parent_index)
+        if kind in FUNCTION_KINDS:
+            result_type = self._type(cursor.result_type)
+            flags |= (cursor.is_const_method() and CONST_METHOD) | (cursor.is_static_method() and STATIC_METHOD) | \
+                (cursor.is_virtual_method() and VIRTUAL_METHOD) | \
+                (cursor.is_pure_virtual_method() and PURE_VIRTUAL_METHOD)
+        elif kind in TYPEDEF_KINDS:
+            underlying = self._type(cursor.underlying_typedef_type)
+        record = [kind.value, cursor.spelling, cursor.displayname, cursor.access_specifier.value,
+                  cursor.storage_class.value, self._location(cursor.location),
+                  self._location(extent.start) + self._location(extent.end), semantic_parent, self._type(cursor.type),
+                  result_type, underlying, flags, default]
+        children = []
+        for child in get_children(cursor):
+            child_flags = 0
+            if kind in CONTAINER_KINDS:
+                if not self.in_main_file(child):
+                    children.append(self._stub(child))
+                    continue
+                child_flags = IN_MAIN_FILE
+            elif kind == CursorKind.PARM_DECL:
+                #
+                # The default value has been recorded in place of the expression.
+                #
+                children.append(self._stub(child))
+                continue
+            child_default = None
+            if child.kind == CursorKind.PARM_DECL and kind in FUNCTION_KINDS:
+                child_default = self.parameter_default(cursor, child)
+            children.append(self._cursor(child, cursor, index, child_default, child_flags))
+        record.append(tuple(children))
+        self.cursors[index] = record
+        return index
+
+    def _declaration(self, cursor):
+        """
+        A cursor referred to from outside the tree of recorded cursors is recorded as a stub with an extent, and with
+        its own semantic parents so that scopes can be worked out.
+        """
+        index = self.cursor_indices.get(cursor)
+        if index is None:
+            extent = cursor.extent
+            index = self.cursor_indices[cursor] = len(self.cursors)
+            self.cursors.append([cursor.kind.value, cursor.spelling, cursor.displayname, 0, 0,
+                                 self._location(cursor.location),
+                                 self._location(extent.start) + self._location(extent.end), -1, -1, -1, -1, 0, None,
+                                 ()])
+            self.cursors[index][7] = self._semantic_parent(index, cursor)
+        return index
+
+    def record(self):
+        self.parents = []
+        root = self._cursor(self.tu.cursor)
+        #
+        # Now all the cursors in the header are known, resolve the declarations of the types, and the semantic
+        # parents. Resolving a semantic parent may add another.
+        #
+        for index, cursor in self.declarations:
+            self.types[index][3] = self._declaration(cursor)
+        i = 0
+        while i < len(self.parents):
+            index, cursor = self.parents[i]
+            self.cursors[index][7] = self._declaration(cursor)
+            i += 1
+        diagnostics = []
+        for diag in self.tu.diagnostics:
+            diagnostics.append((diag.severity, self._location(diag.location), diag.spelling))
+        includes = []
+        for include in self.tu.get_includes():
+            location = include.location
+            includes.append((self._file(include.source), self._file(include.include),
+                             (self._file(location.file), location.line, location.column, location.offset),
+                             include.depth))
+        return {
+            "spelling": self.tu.spelling,
+            "files": self.files,
+            "types": [tuple(t) for t in self.types],
+            "cursors": [tuple(c) for c in self.cursors],
+            "root": root,
+            "diagnostics": diagnostics,
+            "includes": includes,
+        }
+
+
+def _restore(tables, dependencies):
+    """
+    Rebuild the objects from the tables.
+    """
+    files = [SnapshotFile(f) for f in tables["files"]]
+
+    def location(l):
+        return SnapshotLocation(files[l[0]] if l[0] >= 0 else None, l[1], l[2], l[3])
+
+    tu = SnapshotTU()
+    tu.spelling = tables["spelling"]
+    tu.dependencies = dependencies
+    types = []
+    for kind, spelling, canonical, declaration in tables["types"]:
+        types.append(SnapshotType(TypeKind.from_id(kind), spelling))
+    #
+    # Libclang hands back an invalid type rather than None.
+    #
+    invalid = SnapshotType(TypeKind.INVALID, "")
+    records = tables["cursors"]
+    cursors = [SnapshotCursor() for i in range(len(records))]
+    for cursor, record in zip(cursors, records):
+        kind, spelling, displayname, access, storage, loc, extent, parent, type, result_type, underlying, flags, \
+            default, children = record
+        cursor.kind = CursorKind.from_id(kind)
+        cursor.spelling = spelling
+        cursor.displayname = displayname
+        cursor.access_specifier = AccessSpecifier.from_id(access)
+        cursor.storage_class = StorageClass.from_id(storage)
+        cursor.location = location(loc)
+        cursor.extent = SnapshotExtent(location(extent[0:4]), location(extent[4:8])) if extent else None
+        cursor.semantic_parent = cursors[parent] if parent >= 0 else None
+        cursor.type = types[type] if type >= 0 else invalid
+        cursor.result_type = types[result_type] if result_type >= 0 else invalid
+        cursor.underlying_typedef_type = types[underlying] if underlying >= 0 else invalid
+        cursor.translation_unit = tu
+        cursor.default_value = default
+        cursor._flags = flags
+        cursor._children = [cursors[c] for c in children]
+    for type, record in zip(types, tables["types"]):
+        type._canonical = types[record[2]]
+        if record[3] >= 0:
+            type._declaration = cursors[record[3]]
+    tu.cursor = cursors[tables["root"]]
+    tu.diagnostics = [SnapshotDiagnostic(d[0], location(d[1]), d[2]) for d in tables["diagnostics"]]
+    tu._includes = [SnapshotInclusion(files[s], files[i], location(l), d) for s, i, l, d in tables["includes"]]
+    return tu
+
+
+def _stamp(filename):
+    st = os.stat(filename)
+    return st.st_mtime, st.st_size
+
+
+def save(snapshot_file, tu, parameter_default, dependencies):
+    """
+    Record a snapshot of a translation unit.
+
+    :param snapshot_file:       The file to write.
+    :param tu:                  The clang.cindex.TranslationUnit.
+    :param parameter_default:   Function to compute the default value of a function's parameter, passed the function
+                                and the parameter cursors. This is recorded in place of the tokens of the default.
+    :param dependencies:        The files read to parse the translation unit. The snapshot is only used while these
+                                are unchanged.
+    """
+    snapshot = {
+        "format": FORMAT,
+        "stamps": [(f, _stamp(f)) for f in dependencies],
+        "tables": _Recorder(tu, parameter_default).record(),
+    }
+    data = zlib.compress(pickle.dumps(snapshot, 2))
+    #
+    # Write atomically so that concurrent readers never see a partial snapshot.
+    #
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(snapshot_file))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.rename(tmp, snapshot_file)
+    except:
+        os.remove(tmp)
+        raise
+
+
+def load(snapshot_file):
+    """
+    Restore a snapshot of a translation unit.
+
+    :param snapshot_file:       The file to read.
+    :return:                    A SnapshotTU, or None if there is no usable snapshot because it is missing, was
+                                written by another version, or any of the files read to parse it have changed.
+    """
+    try:
+        with open(snapshot_file, "rb") as f:
+            snapshot = pickle.loads(zlib.decompress(f.read()))
+        if snapshot["format"] != FORMAT:
+            return None
+        for filename, stamp in snapshot["stamps"]:
+            if _stamp(filename) != tuple(stamp):
+                return None
+    except (IOError, OSError, EOFError, ValueError, KeyError, TypeError, zlib.error, pickle.UnpicklingError):
+        return None
+    return _restore(snapshot["tables"], [f for f, stamp in snapshot["stamps"]])
@@ -21,15 +21,25 @@
 from __future__ import print_function
 from abc import *
 import argparse
+import fnmatch
 import gettext
+import hashlib
 import inspect
 import logging
+import marshal
 import os
 import re
 import sys
+import tempfile
 import textwrap
+import time
 import traceback
-from copy import deepcopy
+import types
+from copy import copy
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
 from clang.cindex import CursorKind
 
 from clang.cindex import AccessSpecifier
@@ -39,12 +49,330 @@ class HelpFormatter(argparse.ArgumentDefaultsHelpFormatter, argparse.RawDescript
 
 
 logger = logging.getLogger(__name__)
+#
+# What traced rules did, kept apart so that tracing a few rules does not turn on the rest of the debug output.
+#
+trace_logger = logging.getLogger(__name__ + ".trace")
 gettext.install(__name__)
 _SEPARATOR = "\x00"
 
 # Keep PyCharm happy.
 _ = _
 
+timer = getattr(time, "perf_counter", time.time)
+
+
+def _literal_alternatives(pattern):
+    """
+    If a regular expression can only match a fixed set of strings, return them.
+    For example, "d_func" gives ["d_func"] and "tr|trUtf8" gives ["tr", "trUtf8"].
+
+    :param pattern:             The regular expression.
+    :return:                    The list of strings, or None.
+    """
+    alternatives = [""]
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\":
+            #
+            # Only escaped punctuation is literal.
+            #
+            if i + 1 >= len(pattern) or pattern[i + 1].isalnum():
+                return None
+            alternatives[-1] += pattern[i + 1]
+            i += 2
+            continue
+        if c in ".^$*+?{}[]()":
+            return None
+        if c == "|":
+            alternatives.append("")
+        else:
+            alternatives[-1] += c
+        i += 1
+    return alternatives
+
+
+def _confine_to_field(pattern):
+    """
+    Stop a regular expression from matching across fields. A successful match never spans a separator anyway (see
+    AbstractCompiledRuleDb._build_index), so this does not change what matches, but it does stop patterns such as
+    ".*" from scanning, and backtracking, through the rest of the candidate.
+
+    :param pattern:             The regular expression.
+    :return:                    The regular expression with each "." replaced.
+    """
+    result = []
+    in_class = False
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\":
+            result.append(pattern[i:i + 2])
+            i += 2
+            continue
+        if c == "[" and not in_class:
+            #
+            # A "]" straight after the "[" or "[^" is a literal.
+            #
+            j = i + 1
+            if pattern[j:j + 1] == "^":
+                j += 1
+            if pattern[j:j + 1] == "]":
+                j += 1
+            result.append(pattern[i:j])
+            in_class = True
+            i = j
+            continue
+        if c == "]" and in_class:
+            in_class = False
+        elif c == "." and not in_class:
+            c = "[^\\n" + _SEPARATOR + "]"
+        result.append(c)
+        i += 1
+    return "".join(result)
+
+
+def _snapshot(sip):
+    """
+    Capture a SIP dict before a traced rule runs, so that trace_result() can report what the rule did.
+
+    The values are strings, or sets and lists of strings, so copying the containers one level deep is as good as a
+    deepcopy. Strings, such as a container's body, are shared rather than copied.
+
+    :param sip:                 The SIP dict.
+    :return:                    The snapshot.
+    """
+    return dict((k, copy(v) if isinstance(v, (set, list, dict)) else v) for k, v in sip.items())
+
+
+def iter_fragments(fragments):
+    """
+    Walk the text of a SIP body, as built by the SIP generator.
+
+    :param fragments:           A string, or a list of fragments, each of which is a string or a nested list.
+    :return:                    The strings, in order.
+    """
+    if not isinstance(fragments, list):
+        yield fragments
+        return
+    for fragment in fragments:
+        if isinstance(fragment, list):
+            for text in iter_fragments(fragment):
+                yield text
+        else:
+            yield fragment
+
+
+class SipItem(object):
+    """
+    The SIP form of a C++ item, as passed between the SIP generator, the rules and the emission of the SIP text.
+
+    Rule functions see it as a dict with the keys described for each rule database, and any other keys they add.
+    Values which are lists of strings, such as the parameters of a function, also have a cached joined-up form.
+
+    It is registered as a MutableMapping, and supports the methods of a dict, but it is not a dict, so isinstance(sip,
+    dict) is false, and copy() returns another SipItem. Unlike a dict, it cannot be used as a key.
+    """
+    __slots__ = ["_extra", "_joined"]
+    #
+    # The keys held in slots, in the order they are listed.
+    #
+    FIELDS = ()
+    KEYS = frozenset()
+
+    def __init__(self, name):
+        self._extra = None
+        self._joined = None
+        self.name = name
+        self.annotations = set()
+
+    def __getitem__(self, key):
+        if key in self.KEYS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                pass
+        elif self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self.KEYS:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self.KEYS:
+            try:
+                delattr(self, key)
+                return
+            except AttributeError:
+                pass
+        elif self._extra is not None and key in self._extra:
+            del self._extra[key]
+            return
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        keys = [k for k in self.FIELDS if hasattr(self, k)]
+        if self._extra:
+            keys.extend(self._extra)
+        return keys
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+    def update(self, *args, **kwargs):
+        for k, v in dict(*args, **kwargs).items():
+            self[k] = v
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return value
+
+    def popitem(self):
+        keys = self.keys()
+        if not keys:
+            raise KeyError(_("popitem(): SIP item is empty"))
+        return keys[-1], self.pop(keys[-1])
+
+    def setdefault(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            self[key] = default
+            return default
+
+    def clear(self):
+        for k in self.keys():
+            del self[k]
+
+    def copy(self):
+        """
+        A shallow copy, as for dict.copy().
+        """
+        result = self.__class__.__new__(self.__class__)
+        result._extra = dict(self._extra) if self._extra else None
+        result._joined = None
+        for k in self.FIELDS:
+            try:
+                setattr(result, k, getattr(self, k))
+            except AttributeError:
+                pass
+        return result
+
+    def __eq__(self, other):
+        if not isinstance(other, (SipItem, dict)):
+            return NotImplemented
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __repr__(self):
+        return "{" + ", ".join("{!r}: {!r}".format(k, v) for k, v in self.items()) + "}"
+
+    def joined(self, key):
+        """
+        A value which may be a list of strings, joined up with ", ".
+
+        The result is cached until the value is replaced, or forget_joined() is called because it might have been
+        changed in place.
+        """
+        value = self[key]
+        if not isinstance(value, (list, tuple)):
+            return value
+        if self._joined is None:
+            self._joined = {}
+        cached = self._joined.get(key)
+        if cached is None or cached[0] is not value:
+            cached = self._joined[key] = (value, ", ".join(value))
+        return cached[1]
+
+    def forget_joined(self):
+        self._joined = None
+
+
+MutableMapping.register(SipItem)
+
+
+class ContainerItem(SipItem):
+    FIELDS = ("name", "template_parameters", "decl", "base_specifiers", "body", "annotations")
+    KEYS = frozenset(FIELDS)
+    __slots__ = FIELDS
+
+
+class FunctionItem(SipItem):
+    FIELDS = ("name", "template_parameters", "fn_result", "decl", "prefix", "suffix", "annotations", "decl2",
+              "fn_result2", "code")
+    KEYS = frozenset(FIELDS)
+    __slots__ = FIELDS
+
+
+class ParameterItem(SipItem):
+    FIELDS = ("name", "decl", "init", "annotations")
+    KEYS = frozenset(FIELDS)
+    __slots__ = FIELDS
+
+
+class TypedefItem(SipItem):
+    FIELDS = ("name", "fn_result", "decl", "args", "annotations")
+    KEYS = frozenset(FIELDS)
+    __slots__ = FIELDS
+
+
+class UnexposedItem(SipItem):
+    FIELDS = ("name", "decl", "annotations")
+    KEYS = frozenset(FIELDS)
+    __slots__ = FIELDS
+
+
+class VariableItem(SipItem):
+    FIELDS = ("name", "decl", "annotations")
+    KEYS = frozenset(FIELDS)
+    __slots__ = FIELDS
+
+
+class EnumItem(SipItem):
+    FIELDS = ("name", "enumerations", "annotations")
+    KEYS = frozenset(FIELDS)
+    __slots__ = FIELDS
+
 
 def _parents(container):
     parents = []
@@ -59,43 +387,269 @@ def _parents(container):
     return parents
 
 
+def _tracer(patterns=None):
+    """
+    Decide which rules to trace. This is done once, when the rules are set up, so that rules which are not traced cost
+    nothing each time they are applied.
+
+    :param patterns:            None to trace every rule if debug logging is enabled, otherwise a list of fnmatch
+                                patterns for the names of the rule functions or rule databases to trace.
+    :return:                    A function taking the name of a rule database and a rule function (or None) which
+                                returns whether to trace them.
+    """
+    if patterns is None:
+        enabled = trace_logger.isEnabledFor(logging.DEBUG)
+        return lambda db_name, fn_name: enabled
+
+    def traced(db_name, fn_name):
+        for pattern in patterns:
+            if fnmatch.fnmatchcase(db_name, pattern) or (fn_name and fnmatch.fnmatchcase(fn_name, pattern)):
+                return True
+        return False
+    return traced
+
+
+def _enable_timing(db):
+    """
+    Replace the apply() of a rule database with one which counts and times the calls, and adds the time of each call
+    to the rule which matched, if any. This costs nothing unless it is used.
+
+    :param db:                  The rule database.
+    """
+    if db.timing is not None:
+        return
+    db.timing = [0, 0.0]
+    untimed_apply = db.apply
+
+    def apply(*args, **kwargs):
+        db.matched = None
+        start = timer()
+        try:
+            return untimed_apply(*args, **kwargs)
+        finally:
+            elapsed = timer() - start
+            db.timing[0] += 1
+            db.timing[1] += elapsed
+            if db.matched is not None:
+                db.matched.time += elapsed
+
+    db.apply = apply
+
+
 class Rule(object):
     def __init__(self, db, rule_number, fn, pattern_zip):
         self.db = db
         self.rule_number = rule_number
         self.fn = fn
         self.usage = 0
-        try:
-            groups = ["(?P<{}>{})".format(name, pattern) for pattern, name in pattern_zip]
-            groups = _SEPARATOR.join(groups)
-            self.matcher = re.compile(groups)
-        except Exception as e:
-            groups = ["{} '{}'".format(name, pattern) for pattern, name in pattern_zip]
-            groups = ", ".join(groups)
-            raise RuntimeError(_("Bad {}: {}: {}").format(self, groups, e))
+        #
+        # Whether to snapshot the SIP item before the rule runs, and log what it did. See RuleSet.set_tracing().
+        #
+        self.traced = False
+        #
+        # When the database is timed, the cumulative time of the applications this rule matched.
+        #
+        self.time = 0.0
+        self.pattern_zip = list(pattern_zip)
+        self.literals = [_literal_alternatives(pattern) for pattern, name in self.pattern_zip]
+        groups = ["(?P<{}>{})".format(name, pattern) for pattern, name in self.pattern_zip]
+        self.pattern = _SEPARATOR.join(groups)
+        #
+        # Compiling the rule's own matcher is most of the cost of setting up the rules, and most rules are only ever
+        # tried as part of a _CombinedMatcher, or not at all, so it is compiled when first needed. See check().
+        #
+        self._matcher = None
+        #
+        # The form used in a _CombinedMatcher, if it can be used in one.
+        #
+        self.combinable = None
+        if not any(_CombinedMatcher.NOT_COMBINABLE.search(pattern) for pattern, name in self.pattern_zip):
+            groups = ["(?P<_r{}_{}>{})".format(rule_number, name, _confine_to_field(pattern))
+                      for pattern, name in self.pattern_zip]
+            self.combinable = _SEPARATOR.join(groups)
+
+    @property
+    def matcher(self):
+        if self._matcher is None:
+            try:
+                self._matcher = re.compile(self.pattern)
+            except Exception as e:
+                groups = ["{} '{}'".format(name, pattern) for pattern, name in self.pattern_zip]
+                groups = ", ".join(groups)
+                raise RuntimeError(_("Bad {}: {}: {}").format(self, groups, e))
+        return self._matcher
+
+    def check(self):
+        """
+        Compile the rule now, to report any error in its patterns.
+        """
+        return self.matcher
 
     def match(self, candidate):
         return self.matcher.match(candidate)
 
     def trace_result(self, parents, item, original, modified):
+        if original is None:
+            return
         fqn = parents + "::" + original["name"] + "[" + str(item.extent.start.line) + "]"
         if not modified["name"]:
-            logger.debug(_("Rule {} suppressed {}, {}").format(self, fqn, original))
+            trace_logger.debug(_("Rule {} suppressed {}, {}").format(self, fqn, original))
         else:
             delta = False
-            for k, v in original.iteritems():
-                if v != modified[k]:
+            for k, v in original.items():
+                #
+                # Unchanged strings, such as a container's body, are usually the very same object.
+                #
+                if v is not modified[k] and v != modified[k]:
                     delta = True
                     break
             if delta:
-                logger.debug(_("Rule {} modified {}, {}->{}").format(self, fqn, original, modified))
+                trace_logger.debug(_("Rule {} modified {}, {}->{}").format(self, fqn, original, modified))
             else:
-                logger.warn(_("Rule {} did not modify {}, {}").format(self, fqn, original))
+                trace_logger.warn(_("Rule {} did not modify {}, {}").format(self, fqn, original))
 
     def __str__(self):
         return "[{},{}]".format(self.rule_number, self.fn.__name__)
 
 
+class _RuleMatch(object):
+    """
+    The part of a match against a combined rule matcher which belongs to one rule. This presents the same groups as
+    a match against that rule's own matcher, which is what rule functions expect.
+    """
+    def __init__(self, match, rule, offset):
+        self._match = match
+        self._prefix = "_r{}_".format(rule.rule_number)
+        self._offset = offset
+        self._rule = rule
+        self.string = match.string
+        self.pos = match.pos
+        self.endpos = match.endpos
+
+    @property
+    def re(self):
+        return self._rule.matcher
+
+    def _group(self, group):
+        if isinstance(group, int):
+            return self._offset + group if group else 0
+        return self._prefix + group
+
+    def group(self, *groups):
+        if not groups:
+            groups = (0, )
+        result = tuple(self._match.group(self._group(g)) for g in groups)
+        return result[0] if len(result) == 1 else result
+
+    def __getitem__(self, group):
+        return self.group(group)
+
+    def groups(self, default=None):
+        groups = [self._match.group(self._offset + i) for i in range(1, self.re.groups + 1)]
+        return tuple(default if g is None else g for g in groups)
+
+    def groupdict(self, default=None):
+        result = {}
+        for name in self.re.groupindex:
+            value = self._match.group(self._prefix + name)
+            result[name] = default if value is None else value
+        return result
+
+    def start(self, group=0):
+        return self._match.start(self._group(group))
+
+    def end(self, group=0):
+        return self._match.end(self._group(group))
+
+    def span(self, group=0):
+        return self._match.span(self._group(group))
+
+
+class _CombinedMatcher(object):
+    """
+    Match an ordered list of rules in one pass.
+
+    The rules are compiled into an alternation, with each rule's groups renamed so they cannot clash, and the whole
+    of each rule wrapped in a group named for it. The regular expression engine tries alternatives in order, so the
+    first matching rule wins just as if the rules had been tried one at a time, and the wrapping group identifies it.
+    Rules which use backreferences or inline flags cannot safely be combined, and are matched on their own.
+    """
+    NOT_COMBINABLE = re.compile(r"\(\?[^:]|\\[0-9]")
+    #
+    # Older versions of Python limit the number of groups in a regular expression.
+    #
+    MAX_GROUPS = 100 if sys.version_info < (3, 5) else 10000
+
+    def __init__(self, rules):
+        """
+        Constructor.
+
+        :param rules:               The rules, in order.
+        """
+        self.parts = []
+        chunk = []
+        groups = 0
+        for rule in rules:
+            if not rule.combinable:
+                self._add_chunk(chunk)
+                self.parts.append((None, [rule]))
+                chunk = []
+                groups = 0
+                continue
+            #
+            # Every group starts with a "(", so counting them gives a bound without compiling the rule.
+            #
+            rule_groups = rule.combinable.count("(") + 1
+            if groups + rule_groups > _CombinedMatcher.MAX_GROUPS:
+                self._add_chunk(chunk)
+                chunk = []
+                groups = 0
+            chunk.append(rule)
+            groups += rule_groups
+        self._add_chunk(chunk)
+
+    def _add_chunk(self, rules):
+        if not rules:
+            return
+        if len(rules) == 1:
+            self.parts.append((None, rules))
+            return
+        branches = ["(?P<_r{}>{})".format(rule.rule_number, rule.combinable) for rule in rules]
+        try:
+            combined = re.compile("|".join(branches))
+        except Exception:
+            #
+            # Report the rule at fault.
+            #
+            for rule in rules:
+                try:
+                    re.compile(rule.combinable)
+                except Exception as e:
+                    groups = ", ".join("{} '{}'".format(name, pattern) for pattern, name in rule.pattern_zip)
+                    raise RuntimeError(_("Bad {}: {}: {}").format(rule, groups, e))
+            raise
+        self.parts.append((combined, dict(("_r{}".format(rule.rule_number), rule) for rule in rules)))
+
+    def match(self, candidate):
+        """
+        Find the first matching rule.
+
+        :param candidate:           The candidate string.
+        :return:                    The match object and rule, or None, None.
+        """
+        for combined, rules in self.parts:
+            if combined:
+                match = combined.match(candidate)
+                if match:
+                    rule = rules[match.lastgroup]
+                    return _RuleMatch(match, rule, combined.groupindex[match.lastgroup]), rule
+            else:
+                match = rules[0].match(candidate)
+                if match:
+                    return match, rules[0]
+        return None, None
+
+
 class AbstractCompiledRuleDb(object):
     __metaclass__ = ABCMeta
 
@@ -109,8 +663,74 @@ class AbstractCompiledRuleDb(object):
             self.compiled_rules.append(Rule(db, i, raw_rule[-1], z))
         self.parameter_names = parameter_names
         self.candidate_formatter = _SEPARATOR.join(["{}"] * len(parameter_names))
+        self.timing = None
+        self.matched = None
+        self.set_tracing(_tracer())
+        self._build_index()
+
+    def _build_index(self):
+        """
+        Index the rules for fast dispatch.
+
+        Each field in the candidate is matched exactly, except the last which has no trailing separator and so is
+        only matched as a prefix. Thus, a rule which has a field (other than the last) that can only match a fixed set
+        of strings, such as "d_func", can only match candidates with one of those values in that field. Such rules are
+        indexed by the first such field and value. The remaining "wildcard" rules must always be tried, so they are
+        compiled into a single combined matcher.
+        """
+        self.wildcard_rules = []
+        self.dispatch = {}
+        for rule in self.compiled_rules:
+            for field, literals in enumerate(rule.literals[:-1]):
+                if literals is not None:
+                    for value in set(literals):
+                        self.dispatch.setdefault((field, value), []).append(rule)
+                    break
+            else:
+                self.wildcard_rules.append(rule)
+        self.indexed_fields = sorted(set(field for field, value in self.dispatch))
+        self.wildcard_matcher = _CombinedMatcher(self.wildcard_rules)
+
+    def _indexed_rules(self, values):
+        """
+        The indexed rules which might match the given field values, in order.
+        """
+        lists = []
+        for field in self.indexed_fields:
+            rules = self.dispatch.get((field, values[field]))
+            if rules:
+                lists.append(rules)
+        if len(lists) <= 1:
+            return lists[0] if lists else []
+        return sorted(set().union(*lists), key=lambda r: r.rule_number)
 
     def _match(self, *args):
+        values = ["{}".format(arg) for arg in args]
+        candidate = _SEPARATOR.join(values)
+        #
+        # One pass finds the first matching wildcard rule. Only the indexed rules which come before it need to be
+        # tried, so the first matching rule still wins.
+        #
+        matcher, rule = self.wildcard_matcher.match(candidate)
+        for indexed_rule in self._indexed_rules(values):
+            if rule and indexed_rule.rule_number > rule.rule_number:
+                break
+            indexed_matcher = indexed_rule.match(candidate)
+            if indexed_matcher:
+                matcher, rule = indexed_matcher, indexed_rule
+                break
+        if matcher:
+            #
+            # Only use the first matching rule.
+            #
+            rule.usage += 1
+            self.matched = rule
+        return matcher, rule
+
+    def _match_linear(self, *args):
+        """
+        Match by trying every rule in turn. The reference for _match(), used by the benchmark.
+        """
         candidate = self.candidate_formatter.format(*args)
         for rule in self.compiled_rules:
             matcher = rule.match(candidate)
@@ -131,6 +751,57 @@ class AbstractCompiledRuleDb(object):
         for rule in self.compiled_rules:
             fn(self.__class__.__name__, str(rule), rule.usage)
 
+    def get_usage(self):
+        """Get the usage counts, in rule order."""
+        return [rule.usage for rule in self.compiled_rules]
+
+    def add_usage(self, usage):
+        """Add usage counts, as returned by get_usage(), for example from another process."""
+        for rule, count in zip(self.compiled_rules, usage):
+            rule.usage += count
+
+    def reset_usage(self):
+        """Zero the usage counts, and any timing."""
+        for rule in self.compiled_rules:
+            rule.usage = 0
+            rule.time = 0.0
+        if self.timing is not None:
+            self.timing = [0, 0.0]
+
+    def check(self):
+        """
+        Compile all the rules now, to report any errors in their patterns.
+        """
+        for rule in self.compiled_rules:
+            rule.check()
+
+    def set_tracing(self, traced):
+        """
+        Choose the rules to trace.
+
+        :param traced:              A function taking the database and rule function names, as returned by _tracer().
+        """
+        db_name = type(self).__name__
+        for rule in self.compiled_rules:
+            rule.traced = traced(db_name, rule.fn.__name__)
+
+    def enable_timing(self):
+        """
+        From now on, keep the count and cumulative time of the applications of the database in timing, and the
+        cumulative time of the applications each rule matched in its time.
+        """
+        _enable_timing(self)
+
+    def get_timing(self):
+        """
+        Get the timing of the database and its rules.
+
+        :return:                    The number of applications, their total time, and a list of the (name, usage,
+                                    time) of each rule.
+        """
+        calls, seconds = self.timing or (0, 0.0)
+        return calls, seconds, [(str(rule), rule.usage, rule.time) for rule in self.compiled_rules]
+
 
 class ContainerRuleDb(AbstractCompiledRuleDb):
     """
@@ -164,7 +835,7 @@ class ContainerRuleDb(AbstractCompiledRuleDb):
             Return a modified declaration for the given container.
 
             :param container:   The clang.cindex.Cursor for the container.
-            :param sip:         A dict with the following keys:
+            :param sip:         A dict-like SipItem with the following keys:
 
                                     name                The name of the container.
                                     template_parameters Any template parameters.
@@ -187,17 +858,23 @@ class ContainerRuleDb(AbstractCompiledRuleDb):
     def __init__(self, db):
         super(ContainerRuleDb, self).__init__(db, ["parents", "container", "template_parameters", "decl", "base_specifiers"])
 
-    def apply(self, container, sip):
+    def apply(self, container, sip, parents=None):
         """
         Walk over the rules database for functions, applying the first matching transformation.
 
         :param container:           The clang.cindex.Cursor for the container.
         :param sip:                 The SIP dict.
+        :param parents:             The FQN of the container's parents, if the caller already knows it.
         """
-        parents = _parents(container)
+        if parents is None:
+            parents = _parents(container)
         matcher, rule = self._match(parents, sip["name"], sip["template_parameters"], sip["decl"], sip["base_specifiers"])
         if matcher:
-            before = deepcopy(sip)
+            #
+            # The body is only joined up for the rules which get to see it.
+            #
+            sip["body"] = "".join(iter_fragments(sip["body"]))
+            before = _snapshot(sip) if rule.traced else None
             rule.fn(container, sip, matcher)
             rule.trace_result(parents, container, before, sip)
 
@@ -236,7 +913,7 @@ class FunctionRuleDb(AbstractCompiledRuleDb):
 
             :param container:   The clang.cindex.Cursor for the container.
             :param function:    The clang.cindex.Cursor for the function.
-            :param sip:         A dict with the following keys:
+            :param sip:         A dict-like SipItem with the following keys:
 
                                     name                The name of the function.
                                     template_parameters Any template parameters.
@@ -261,19 +938,23 @@ class FunctionRuleDb(AbstractCompiledRuleDb):
     def __init__(self, db):
         super(FunctionRuleDb, self).__init__(db, ["container", "function", "template_parameters", "fn_result", "decl"])
 
-    def apply(self, container, function, sip):
+    def apply(self, container, function, sip, parents=None):
         """
         Walk over the rules database for functions, applying the first matching transformation.
 
         :param container:           The clang.cindex.Cursor for the container.
         :param function:            The clang.cindex.Cursor for the function.
         :param sip:                 The SIP dict.
+        :param parents:             The FQN of the function's parents, if the caller already knows it.
         """
-        parents = _parents(function)
-        matcher, rule = self._match(parents, sip["name"], ", ".join(sip["template_parameters"]), sip["fn_result"], ", ".join(sip["decl"]))
+        if parents is None:
+            parents = _parents(function)
+        matcher, rule = self._match(parents, sip["name"], sip.joined("template_parameters"), sip["fn_result"],
+                                    sip.joined("decl"))
         if matcher:
-            before = deepcopy(sip)
+            before = _snapshot(sip) if rule.traced else None
             rule.fn(container, function, sip, matcher)
+            sip.forget_joined()
             rule.trace_result(parents, function, before, sip)
 
 
@@ -314,7 +995,7 @@ class ParameterRuleDb(AbstractCompiledRuleDb):
             :param container:   The clang.cindex.Cursor for the container.
             :param function:    The clang.cindex.Cursor for the function.
             :param parameter:   The clang.cindex.Cursor for the parameter.
-            :param sip:         A dict with the following keys:
+            :param sip:         A dict-like SipItem with the following keys:
 
                                     name                The name of the function.
                                     decl                The declaration.
@@ -333,7 +1014,7 @@ class ParameterRuleDb(AbstractCompiledRuleDb):
     def __init__(self, db):
         super(ParameterRuleDb, self).__init__(db, ["container", "function", "parameter", "decl", "init"])
 
-    def apply(self, container, function, parameter, sip):
+    def apply(self, container, function, parameter, sip, parents=None):
         """
         Walk over the rules database for parameters, applying the first matching transformation.
 
@@ -341,11 +1022,13 @@ class ParameterRuleDb(AbstractCompiledRuleDb):
         :param function:            The clang.cindex.Cursor for the function.
         :param parameter:           The clang.cindex.Cursor for the parameter.
         :param sip:                 The SIP dict.
+        :param parents:             The FQN of the function's parents, if the caller already knows it.
         """
-        parents = _parents(function)
+        if parents is None:
+            parents = _parents(function)
         matcher, rule = self._match(parents, function.spelling, sip["name"], sip["decl"], sip["init"])
         if matcher:
-            before = deepcopy(sip)
+            before = _snapshot(sip) if rule.traced else None
             rule.fn(container, function, parameter, sip, matcher)
             rule.trace_result(parents, parameter, before, sip)
 
@@ -380,7 +1063,7 @@ class TypedefRuleDb(AbstractCompiledRuleDb):
 
             :param container:   The clang.cindex.Cursor for the container.
             :param typedef:     The clang.cindex.Cursor for the typedef.
-            :param sip:         A dict with the following keys:
+            :param sip:         A dict-like SipItem with the following keys:
 
                                     name                The name of the typedef.
                                     fn_result           Result, for a function pointer.
@@ -400,18 +1083,20 @@ class TypedefRuleDb(AbstractCompiledRuleDb):
     def __init__(self, db):
         super(TypedefRuleDb, self).__init__(db, ["container", "typedef", "fn_result", "decl"])
 
-    def apply(self, container, typedef, sip):
+    def apply(self, container, typedef, sip, parents=None):
         """
         Walk over the rules database for typedefs, applying the first matching transformation.
 
         :param container:           The clang.cindex.Cursor for the container.
         :param typedef:             The clang.cindex.Cursor for the typedef.
         :param sip:                 The SIP dict.
+        :param parents:             The FQN of the typedef's parents, if the caller already knows it.
         """
-        parents = _parents(typedef)
+        if parents is None:
+            parents = _parents(typedef)
         matcher, rule = self._match(parents, sip["name"], sip["fn_result"], sip["decl"])
         if matcher:
-            before = deepcopy(sip)
+            before = _snapshot(sip) if rule.traced else None
             rule.fn(container, typedef, sip, matcher)
             rule.trace_result(parents, typedef, before, sip)
 
@@ -445,7 +1130,7 @@ class UnexposedRuleDb(AbstractCompiledRuleDb):
 
             :param container:   The clang.cindex.Cursor for the container.
             :param unexposed:   The clang.cindex.Cursor for the unexposed item.
-            :param sip:         A dict with the following keys:
+            :param sip:         A dict-like SipItem with the following keys:
 
                                     name                The name of the unexposed item.
                                     decl                The declaration.
@@ -464,18 +1149,20 @@ class UnexposedRuleDb(AbstractCompiledRuleDb):
     def __init__(self, db):
         super(UnexposedRuleDb, self).__init__(db, ["container", "unexposed", "decl"])
 
-    def apply(self, container, unexposed, sip):
+    def apply(self, container, unexposed, sip, parents=None):
         """
         Walk over the rules database for unexposed items, applying the first matching transformation.
 
         :param container:           The clang.cindex.Cursor for the container.
         :param unexposed:           The clang.cindex.Cursor for the unexposed item.
         :param sip:                 The SIP dict.
+        :param parents:             The FQN of the unexposed item's parents, if the caller already knows it.
         """
-        parents = _parents(unexposed)
+        if parents is None:
+            parents = _parents(unexposed)
         matcher, rule = self._match(parents, sip["name"], sip["decl"])
         if matcher:
-            before = deepcopy(sip)
+            before = _snapshot(sip) if rule.traced else None
             rule.fn(container, unexposed, sip, matcher)
             rule.trace_result(parents, unexposed, before, sip)
 
@@ -510,7 +1197,7 @@ class VariableRuleDb(AbstractCompiledRuleDb):
 
             :param container:   The clang.cindex.Cursor for the container.
             :param variable:    The clang.cindex.Cursor for the variable.
-            :param sip:         A dict with the following keys:
+            :param sip:         A dict-like SipItem with the following keys:
 
                                     name                The name of the variable.
                                     decl                The declaration.
@@ -529,33 +1216,50 @@ class VariableRuleDb(AbstractCompiledRuleDb):
     def __init__(self, db):
         super(VariableRuleDb, self).__init__(db, ["container", "variable", "decl"])
 
-    def apply(self, container, variable, sip):
+    def apply(self, container, variable, sip, parents=None):
         """
         Walk over the rules database for variables, applying the first matching transformation.
 
         :param container:           The clang.cindex.Cursor for the container.
         :param variable:            The clang.cindex.Cursor for the variable.
         :param sip:                 The SIP dict.
+        :param parents:             The FQN of the variable's parents, if the caller already knows it.
         """
-        parents = _parents(variable)
+        if parents is None:
+            parents = _parents(variable)
         matcher, rule = self._match(parents, sip["name"], sip["decl"])
         if matcher:
-            before = deepcopy(sip)
+            before = _snapshot(sip) if rule.traced else None
             rule.fn(container, variable, sip, matcher)
             rule.trace_result(parents, variable, before, sip)
 
 
+def _normalise_code(code):
+    """
+    Tidy up the text of some %MethodCode, or similar.
+    """
+    return textwrap.dedent(code).strip() + "\n"
+
+
 class AbstractCompiledCodeDb(object):
     __metaclass__ = ABCMeta
 
     def __init__(self, db):
         self.db = db
+        self.timing = None
+        self.matched = None
+        self.set_tracing(_tracer())
         #
-        # Add a usage count for each item in the database.
+        # Add a usage count for each item in the database, and index the items by (FQN of container, name), with the
+        # names on their own so that most lookups do not need the FQN at all.
         #
+        self.entries = {}
+        self.names = set()
         for k, v in self.db.items():
             for l in v.keys():
                 v[l]["usage"] = 0
+                self.entries[(k, l)] = v[l]
+                self.names.add(l)
 
     def dump_usage(self, fn):
         """ Dump the usage counts."""
@@ -565,37 +1269,94 @@ class AbstractCompiledCodeDb(object):
                 vl = vk[l]
                 fn(type(self).__name__, "[" + k + "," + l + "]", vl["usage"])
 
-    def _get(self, item, name):
-        #
-        # Lookup any parent-level entries.
-        #
-        parents = _parents(item)
-        entries = self.db.get(parents, None)
-        if not entries:
-            return None
-        #
-        # Now look for an actual hit.
-        #
-        entry = entries.get(name, None)
+    def _entries(self):
+        for k in sorted(self.db.keys()):
+            vk = self.db[k]
+            for l in sorted(vk.keys()):
+                yield vk[l]
+
+    def get_usage(self):
+        """Get the usage counts, in sorted key order."""
+        return [entry["usage"] for entry in self._entries()]
+
+    def add_usage(self, usage):
+        """Add usage counts, as returned by get_usage(), for example from another process."""
+        for entry, count in zip(self._entries(), usage):
+            entry["usage"] += count
+
+    def reset_usage(self):
+        """Zero the usage counts, and any timing."""
+        for entry in self._entries():
+            entry["usage"] = 0
+        if self.timing is not None:
+            self.timing = [0, 0.0]
+
+    def check(self):
+        """
+        There are no patterns to check.
+        """
+        pass
+
+    def set_tracing(self, traced):
+        """
+        Choose whether to trace the database. Entries are not traced separately.
+
+        :param traced:              A function taking the database and rule function names, as returned by _tracer().
+        """
+        self.traced = traced(type(self).__name__, None)
+
+    def enable_timing(self):
+        """
+        From now on, keep the count and cumulative time of the applications of the database in timing.
+        """
+        _enable_timing(self)
+
+    def get_timing(self):
+        """
+        Get the timing of the database, as for AbstractCompiledRuleDb.get_timing(). Entries are not timed separately.
+        """
+        calls, seconds = self.timing or (0, 0.0)
+        return calls, seconds, []
+
+    def _get(self, item, name, parents=None):
+        """
+        Look up the entry for an item.
+
+        :param item:                The clang.cindex.Cursor for the item.
+        :param name:                The name of the item.
+        :param parents:             The FQN of the item's parents, if the caller already knows it.
+        :return:                    The (FQN, name) key and the entry, or None, None.
+        """
+        if name not in self.names:
+            return None, None
+        if parents is None:
+            parents = _parents(item)
+        key = (parents, name)
+        entry = self.entries.get(key)
         if not entry:
-            return None
+            return None, None
         entry["usage"] += 1
-        return entry
+        return key, entry
 
     def trace_result(self, parents, item, original, modified):
+        if original is None:
+            return
         fqn = parents + "::" + original["name"] + "[" + str(item.extent.start.line) + "]"
         if not modified["name"]:
-            logger.debug(_("Rule {} suppressed {}, {}").format(self, fqn, original))
+            trace_logger.debug(_("Rule {} suppressed {}, {}").format(self, fqn, original))
         else:
             delta = False
-            for k, v in original.iteritems():
-                if v != modified[k]:
+            for k, v in original.items():
+                #
+                # Unchanged strings, such as a container's body, are usually the very same object.
+                #
+                if v is not modified[k] and v != modified[k]:
                     delta = True
                     break
             if delta:
-                logger.debug(_("Rule {} modified {}, {}->{}").format(self, fqn, original, modified))
+                trace_logger.debug(_("Rule {} modified {}, {}->{}").format(self, fqn, original, modified))
             else:
-                logger.warn(_("Rule {} did not modify {}, {}").format(self, fqn, original))
+                trace_logger.warn(_("Rule {} did not modify {}, {}").format(self, fqn, original))
 
 
 class MethodCodeDb(AbstractCompiledCodeDb):
@@ -629,6 +1390,10 @@ class MethodCodeDb(AbstractCompiledCodeDb):
         "code":         Required. Either a string, with the %MethodCode
                         contents, or is a callable.
 
+    The database is indexed, and the string "code" entries are tidied up,
+    when it is compiled, so changes made to the raw database afterwards are
+    not seen.
+
     In use, the database is directly indexed by "container" and then method
     name. If "code" entry is a string, then the other optional keys are
     interpreted as above. If "code" is a callable, it is called with the
@@ -639,7 +1404,7 @@ class MethodCodeDb(AbstractCompiledCodeDb):
             Return a modified declaration for the given function.
 
             :param function:    The clang.cindex.Cursor for the function.
-            :param sip:         A dict with keys as for function rules
+            :param sip:         A dict-like SipItem with keys as for function rules
                                 plus the "decl2", "fn_result2" and (string)
                                 "code" keys described above.
             :param sip:         The inner dictionary entry.
@@ -653,9 +1418,24 @@ class MethodCodeDb(AbstractCompiledCodeDb):
 
     def __init__(self, db):
         super(MethodCodeDb, self).__init__(db)
+        #
+        # Tidy up the text of each string "code" once, rather than each time it is used.
+        #
+        self.code = {}
+        for key, entry in self.entries.items():
+            code = entry.get("code")
+            if code is not None and not callable(code):
+                self.code[key] = _normalise_code(code)
+
+    def apply(self, function, sip, parents=None):
+        """
+        Apply any entry for a function.
 
-    def apply(self, function, sip):
-        entry = self._get(function, sip["name"])
+        :param function:            The clang.cindex.Cursor for the function.
+        :param sip:                 The SIP dict.
+        :param parents:             The FQN of the function's parents, if the caller already knows it.
+        """
+        key, entry = self._get(function, sip["name"], parents)
         #
         # SIP supports the notion of a second C++ signature as well as the normal signature. By default, this
         # is not present.
@@ -664,11 +1444,14 @@ class MethodCodeDb(AbstractCompiledCodeDb):
         sip["fn_result2"] = ""
         sip["code"] = ""
         if entry:
-            before = deepcopy(sip)
+            before = _snapshot(sip) if self.traced else None
             sip["code"] = entry["code"]
             if callable(sip["code"]):
                 sip["code"](function, sip, entry)
+                sip.forget_joined()
+                sip["code"] = _normalise_code(sip["code"])
             else:
+                sip["code"] = self.code[key]
                 sip["decl"] = entry.get("decl", sip["decl"])
                 sip["fn_result"] = entry.get("fn_result", sip["fn_result"])
                 #
@@ -678,11 +1461,7 @@ class MethodCodeDb(AbstractCompiledCodeDb):
                 if "decl2" in entry or "fn_result2" in entry:
                     sip["decl2"] = entry.get("decl2", sip["decl"])
                     sip["fn_result2"] = entry.get("fn_result2", sip["fn_result2"])
-            #
-            # Fetch/format the code.
-            #
-            sip["code"] = textwrap.dedent(sip["code"]).strip() + "\n"
-            self.trace_result(_parents(function), function, before, sip)
+            self.trace_result(key[0], function, before, sip)
 
 
 class RuleSet(object):
@@ -693,6 +1472,21 @@ class RuleSet(object):
 
     You then simply run the SIP generation and SIP compilation programs passing
     in the name of your rules file
+
+    The sip passed to the rules is a SipItem, which behaves like a dict except
+    that isinstance(sip, dict) is false, copy() returns another SipItem, and it
+    cannot be used as a key.
+
+    The rules are passed clang.cindex cursors, except when the generator is run
+    with --snapshot-dir and replays an unchanged header from its snapshot. Then
+    they are passed ast_snapshot.SnapshotCursor objects, which only have the
+    kind, spelling, displayname, access_specifier, storage_class, location,
+    extent, semantic_parent, type, result_type, underlying_typedef_type and
+    translation_unit attributes, and the get_children() and is_*_method()
+    methods. Their types only have kind, spelling, get_canonical() and
+    get_declaration(). Children outside the header, and the expressions of
+    default values, only have their kind and location. Rules which need more,
+    such as get_tokens() or referenced, should not be used with snapshots.
     """
     __metaclass__ = ABCMeta
 
@@ -770,9 +1564,17 @@ class RuleSet(object):
     def methodcode(self, container, function):
         """
         %Methodcode.
+
+        An implementation may also take a parents argument, the FQN of the
+        function's parents, which the SIP generator then passes to save
+        working it out again.
         """
         raise NotImplemented(_("Missing subclass implementation"))
 
+    def _rule_dbs(self):
+        return [self.container_rules(), self.function_rules(), self.parameter_rules(), self.typedef_rules(),
+                self.unexposed_rules(), self.variable_rules(), self.methodcode_rules()]
+
     def dump_unused(self):
         """Usage statistics, to identify unused rules."""
         def dumper(db_name, rule, usage):
@@ -780,10 +1582,65 @@ class RuleSet(object):
                 logger.info(_("Rule {}::{} used {} times".format(db_name, rule, usage)))
             else:
                 logger.warn(_("Rule {}::{} unused".format(db_name, rule)))
-        for db in [self.container_rules(), self.function_rules(), self.parameter_rules(), self.typedef_rules(),
-                   self.unexposed_rules(), self.variable_rules(), self.methodcode_rules()]:
+        for db in self._rule_dbs():
             db.dump_usage(dumper)
 
+    def get_usage(self):
+        """
+        Get the usage counts of all the rules. Used to merge the statistics gathered by worker processes.
+
+        :return: A list with the usage counts of each database.
+        """
+        return [db.get_usage() for db in self._rule_dbs()]
+
+    def add_usage(self, usage):
+        """
+        Add in usage counts as returned by get_usage().
+
+        :param usage:               The usage counts to add.
+        """
+        for db, db_usage in zip(self._rule_dbs(), usage):
+            db.add_usage(db_usage)
+
+    def reset_usage(self):
+        """Zero the usage counts, and any timing, of all the rules."""
+        for db in self._rule_dbs():
+            db.reset_usage()
+
+    def check(self):
+        """
+        Compile all the rules now, rather than as each is first needed, to report any errors in their patterns.
+        """
+        for db in self._rule_dbs():
+            db.check()
+
+    def set_tracing(self, patterns=None):
+        """
+        Choose the rules to trace. A traced rule logs what it did to each item it matched to trace_logger, at debug
+        level, or warns if it did nothing. By default, every rule is traced if debug logging was enabled when the
+        rules were set up. Rules which are not traced are not checked for doing nothing.
+
+        :param patterns:            None for the default, otherwise a list of fnmatch patterns for the names of the
+                                    rule functions or rule databases to trace, such as "_function_discard" or
+                                    "FunctionRuleDb".
+        """
+        traced = _tracer(patterns)
+        for db in self._rule_dbs():
+            db.set_tracing(traced)
+
+    def enable_timing(self):
+        """Time the application of all the rules from now on. See AbstractCompiledRuleDb.enable_timing()."""
+        for db in self._rule_dbs():
+            db.enable_timing()
+
+    def get_timing(self):
+        """
+        Get the timing of all the rules.
+
+        :return:                    A dict of the get_timing() of each database, by database class name.
+        """
+        return dict((type(db).__name__, db.get_timing()) for db in self._rule_dbs())
+
     def _check_directory_list(self, paths):
         """Check a command separated list of path are all diectories."""
         paths = paths.split(",")
@@ -957,29 +1814,188 @@ class Qt5Rules(RuleSet):
     def includes(self):
         return self._includes
 
-    def methodcode(self, function, sip):
-        self._methodcode.apply(function, sip)
+    def methodcode(self, function, sip, parents=None):
+        self._methodcode.apply(function, sip, parents)
+
+try:
+    from importlib.util import MAGIC_NUMBER
+except ImportError:
+    import imp
+    MAGIC_NUMBER = imp.get_magic()
 
-def rules(project_rules, includes):
+
+def _cache_file(project_rules, cache_dir, key, suffix):
+    """
+    A file in the cache for the rules file. Only the newest file of each kind is kept for a given rules file, so
+    that the cache does not fill with files for superseded versions of it.
+
+    :param project_rules:       The (absolute) rules file for the project.
+    :param cache_dir:           The directory to keep the file in.
+    :param key:                 The key for the content of the file.
+    :param suffix:              The kind of file.
+    :return:                    The filename.
+    """
+    prefix = "rules-" + hashlib.sha1(project_rules.encode("utf-8")).hexdigest()[:16] + "-"
+    return os.path.join(cache_dir, prefix + key + suffix)
+
+
+def _prune_cache_files(cache_file):
+    """
+    Remove the files superseded by a newly written cache file.
+
+    :param cache_file:          A filename from _cache_file().
+    """
+    cache_dir, name = os.path.split(cache_file)
+    prefix = name[:name.rindex("-") + 1]
+    suffix = os.path.splitext(name)[1]
+    for other in fnmatch.filter(os.listdir(cache_dir), prefix + "*" + suffix):
+        if other != name:
+            try:
+                os.remove(os.path.join(cache_dir, other))
+            except OSError:
+                pass
+
+
+def _load_rules_module(project_rules, cache_dir=None):
+    """
+    Load the rules file as the module "project_rules".
+
+    :param project_rules:       The rules file for the project.
+    :param cache_dir:           Optional directory to keep the compiled rules file in, keyed by its content, so that
+                                it is compiled once rather than in every run.
+    :return:                    The module.
+    """
+    with open(project_rules, "rb") as f:
+        source = f.read()
+    project_rules = os.path.abspath(project_rules)
+    code = None
+    if cache_dir:
+        #
+        # The bytecode depends on the version of Python, and the filename is recorded in it for tracebacks.
+        #
+        key = hashlib.sha1(source + MAGIC_NUMBER + project_rules.encode("utf-8")).hexdigest()
+        cache_file = _cache_file(project_rules, cache_dir, key, ".code")
+        try:
+            with open(cache_file, "rb") as f:
+                code = marshal.loads(f.read())
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            code = None
+    if code is None:
+        code = compile(source, project_rules, "exec", 0, True)
+        if cache_dir:
+            #
+            # Write atomically so that concurrent readers never see a partial file.
+            #
+            fd, tmp = tempfile.mkstemp(dir=cache_dir)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(marshal.dumps(code))
+                os.rename(tmp, cache_file)
+            except Exception:
+                os.remove(tmp)
+                raise
+            _prune_cache_files(cache_file)
+    module = types.ModuleType("project_rules")
+    module.__file__ = project_rules
+    sys.modules["project_rules"] = module
+    try:
+        exec(code, module.__dict__)
+    except Exception:
+        #
+        # Do not leave a half-initialised module behind for a later import to find.
+        #
+        del sys.modules["project_rules"]
+        raise
+    return module
+
+
+def _checked_file(rule_set, project_rules, cache_dir):
+    """
+    The file recording that the patterns of a set of rules have been checked. The patterns may come from modules
+    which the rules file imports, as well as from the rules file itself, so the file is keyed by the patterns
+    themselves.
+    """
+    hasher = hashlib.sha1(MAGIC_NUMBER)
+    for db in rule_set._rule_dbs():
+        for rule in getattr(db, "compiled_rules", []):
+            hasher.update(repr(rule.pattern).encode("utf-8"))
+    return _cache_file(os.path.abspath(project_rules), cache_dir, hasher.hexdigest(), ".checked")
+
+
+def rules(project_rules, includes, cache_dir=None):
     """
     Constructor.
 
+    The rules are compiled as each is first needed, except when their patterns are new or have changed, when they are
+    all checked straight away so that any mistakes are reported at once.
+
     :param project_rules:       The rules file for the project.
     :param includes:            A list of roots of includes file, typically including the root for all Qt and
                                 the root for all KDE include files as well as any project-specific include files.
+    :param cache_dir:           Optional directory to keep the compiled rules file, and a record of which patterns
+                                have been checked, in.
     """
-    try:
-        import imp
-        imp.load_source("project_rules", project_rules)
-    except ImportError:
-        import importlib
-        spec = importlib.util.spec_from_file_location("project_rules", project_rules)
-        module = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(module)
+    module = _load_rules_module(project_rules, cache_dir)
     #
     # Statically prepare the rule logic. This takes the rules provided by the user and turns them into code.
     #
-    return getattr(sys.modules["project_rules"], "RuleSet")(includes)
+    result = getattr(module, "RuleSet")(includes)
+    checked_file = _checked_file(result, project_rules, cache_dir) if cache_dir else None
+    if not checked_file or not os.path.exists(checked_file):
+        result.check()
+        if checked_file:
+            try:
+                open(checked_file, "w").close()
+                _prune_cache_files(checked_file)
+            except (IOError, OSError):
+                #
+                # Not fatal, we will just check again next time.
+                #
+                pass
+    return result
+
+
+def benchmark(count, candidates=5000):
+    """
+    Compare indexed rule dispatch against trying every rule in turn, using a synthetic function rule database.
+
+    :param count:               The number of rules.
+    :param candidates:          The number of candidates to match.
+    :return:                    The times taken, in seconds, by the linear and indexed forms.
+    """
+    import random
+    import time
+    random.seed(0)
+
+    def synthetic_rules():
+        raw_rules = []
+        for i in range(count):
+            if i % 10 == 9:
+                raw_rules.append([".*", ".*", ".*", ".*", ".*Type{}.*".format(i), _function_discard])
+            elif i % 10 == 8:
+                raw_rules.append(["Ns{}::Class{}".format(i % 7, i), "fn{}|op{}".format(i, i), ".*", ".*", ".*",
+                                  _function_discard])
+            else:
+                raw_rules.append([".*", "fn{}".format(i), ".*", "int|void", ".*", _function_discard])
+        return raw_rules
+
+    db = FunctionRuleDb(synthetic_rules)
+    names = ["fn{}".format(i) for i in range(count)] + ["op{}".format(i) for i in range(count)] + \
+            ["other{}".format(i) for i in range(count)]
+    work = []
+    for i in range(candidates):
+        n = random.randrange(count)
+        work.append(("Ns{}::Class{}".format(n % 7, n), random.choice(names), "", random.choice(["int", "void", "bool"]),
+                     "int a, Type{} *b".format(random.randrange(count))))
+    times = []
+    results = []
+    for fn in [db._match_linear, db._match]:
+        start = time.time()
+        results.append([(rule, matcher and matcher.groupdict()) for matcher, rule in [fn(*args) for args in work]])
+        times.append(time.time() - start)
+    if results[0] != results[1]:
+        raise AssertionError(_("Indexed rule dispatch does not match linear dispatch"))
+    return times
 
 
 def main(argv=None):
@@ -989,18 +2005,26 @@ def main(argv=None):
     Examples:
 
         rules.py
+        rules.py --benchmark 500
     """
     if argv is None:
         argv = sys.argv
     parser = argparse.ArgumentParser(epilog=inspect.getdoc(main),
                                      formatter_class=HelpFormatter)
     parser.add_argument("-v", "--verbose", action="store_true", default=False, help=_("Enable verbose output"))
+    parser.add_argument("--benchmark", type=int, metavar="RULES",
+                        help=_("Time rule matching against a synthetic database with this many rules"))
     try:
         args = parser.parse_args(argv[1:])
         if args.verbose:
             logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(name)s %(levelname)s: %(message)s')
         else:
             logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+        if args.benchmark:
+            linear, indexed = benchmark(args.benchmark)
+            print(_("{} rules: linear {:.3f}s, indexed {:.3f}s, speedup {:.1f}x").format(args.benchmark, linear, indexed,
+                                                                                       linear / indexed))
+            return
         #
         # Generate help!
         #
@@ -0,0 +1,424 @@
+#!/usr/bin/env python
+#
+# Copyright 2026 by agent (agent@local)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301  USA.
+#
+"""Benchmarks for the SIP file generator."""
+from __future__ import print_function
+import argparse
+import difflib
+import gettext
+import inspect
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+import ast_snapshot
+import rules_engine
+import sip_generator
+
+
+class HelpFormatter(argparse.ArgumentDefaultsHelpFormatter, argparse.RawDescriptionHelpFormatter):
+    pass
+
+
+logger = logging.getLogger(__name__)
+gettext.install(__name__)
+
+# Keep PyCharm happy.
+_ = _
+
+timer = getattr(time, "perf_counter", time.time)
+
+PHASES = ["parse", "walk", "rules", "emit", "total"]
+
+#
+# Enough of Qt for the default values and typedefs which the generator treats specially.
+#
+PRELUDE = """
+class QString
+{
+public:
+    QString();
+    QString(const char *s);
+};
+template <typename T> class QFlags
+{
+public:
+    QFlags(T t = T());
+    QFlags(int i);
+};
+namespace Qt
+{
+    enum AlignmentFlag { AlignLeft = 1, AlignRight = 2, AlignCenter = 4 };
+    typedef QFlags<AlignmentFlag> Alignment;
+}
+"""
+
+#
+# Macros for declarations, in a header of their own: what matters is where a macro is used, not where it is defined.
+#
+MACROS_H = "benchmark_macros.h"
+MACROS = """
+#define BENCHMARK_EXPORT __attribute__((visibility("default")))
+#define BENCHMARK_DEPRECATED __attribute__((__deprecated__))
+#define DECLARE_FUNCTION(name) void name(int x)
+#define DECLARE_TYPEDEF(type, name) typedef type name
+#define DECLARE_FLAGS(Flags, Enum) typedef QFlags<Enum> Flags;
+"""
+
+
+def _class(name, methods, pad=""):
+    lines = [pad + "class {}".format(name), pad + "{", pad + "public:",
+             pad + "    {}();".format(name),
+             pad + "    {}(const {} &other);".format(name, name),
+             pad + "    virtual ~{}();".format(name)]
+    for i in range(methods):
+        lines.append(pad + "    int method{}(int a, const QString &s) const;".format(i))
+    lines += [pad + "protected:", pad + "    int m_value;", pad + "};"]
+    return lines
+
+
+def many_classes(scale):
+    """
+    Many small classes in one namespace.
+    """
+    lines = ["namespace Many", "{"]
+    for i in range(scale):
+        lines += _class("Class{}".format(i), 5, "    ")
+    lines.append("}")
+    return lines
+
+
+def deep_namespaces(scale):
+    """
+    Namespaces nested scale deep, with a class at each level.
+    """
+    lines = []
+    for i in range(scale):
+        pad = "    " * i
+        lines += [pad + "namespace Level{}".format(i), pad + "{"]
+        lines += _class("Class{}".format(i), 2, pad + "    ")
+    for i in reversed(range(scale)):
+        lines.append("    " * i + "}")
+    return lines
+
+
+def heavy_defaults(scale):
+    """
+    Methods with many default arguments, of the sorts which need the tokens to be examined.
+    """
+    lines = ["class Defaults", "{", "public:"]
+    for i in range(scale):
+        lines.append("    void method{}(int a = {}, const QString &s = QString(\"x, y\"), double d = ({}.0 + 1), "
+                     "Qt::Alignment f = Qt::AlignLeft, const char *c = \"q\", bool b = sizeof(int) > 2);".format(i, i, i))
+    lines.append("};")
+    return lines
+
+
+def large_enums(scale):
+    """
+    A few enums, each with scale values.
+    """
+    lines = ["class Enums", "{", "public:"]
+    for i in range(5):
+        lines.append("    enum Enum{} {{".format(i))
+        lines += ["        Enum{}Value{} = {},".format(i, j, j) for j in range(scale)]
+        lines.append("    };")
+    lines.append("};")
+    return lines
+
+
+def many_overloads(scale):
+    """
+    One name overloaded many times.
+    """
+    types = ["int", "double", "const QString &", "const char *", "Qt::Alignment", "bool"]
+    lines = ["class Overloads", "{", "public:"]
+    for i in range(scale):
+        params = ", ".join("{} p{}".format(types[(i + j) % len(types)], j) for j in range(i % 5 + 1))
+        lines.append("    void overloaded({}, int n{} = {});".format(params, i, i))
+    lines.append("};")
+    return lines
+
+
+def macro_declarations(scale):
+    """
+    Declarations made by macros from an included header, and classes with export and deprecation macros.
+    """
+    lines = ["#include \"{}\"".format(MACROS_H), "namespace Macros", "{"]
+    for i in range(scale):
+        lines += ["    DECLARE_FUNCTION(function{});".format(i),
+                  "    DECLARE_TYPEDEF(int, Typedef{});".format(i),
+                  "    class BENCHMARK_EXPORT Class{}".format(i), "    {", "    public:",
+                  "        enum Option { First = 1, Second = 2 };",
+                  "        DECLARE_FLAGS(Options, Option)",
+                  "        BENCHMARK_DEPRECATED void old();",
+                  "        void method(Options o);", "    };"]
+    lines.append("}")
+    return lines
+
+
+SHAPES = {
+    "classes": many_classes,
+    "namespaces": deep_namespaces,
+    "defaults": heavy_defaults,
+    "enums": large_enums,
+    "overloads": many_overloads,
+    "macros": macro_declarations,
+}
+
+
+def write_header(directory, shape, scale):
+    """
+    Write a synthetic header.
+
+    :param directory:           Where to write it.
+    :param shape:               One of SHAPES.
+    :param scale:               The size, roughly the number of items of the kind the shape is about.
+    :return:                    The header filename and its number of lines.
+    """
+    lines = ["#ifndef BENCHMARK_H", "#define BENCHMARK_H", PRELUDE] + SHAPES[shape](scale) + ["#endif"]
+    with open(os.path.join(directory, MACROS_H), "w") as f:
+        f.write(MACROS)
+    h_file = os.path.join(directory, "{}_{}.h".format(shape, scale))
+    with open(h_file, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return h_file, len(lines)
+
+
+def _rules_seconds(rules):
+    """
+    The total time spent applying the rules so far.
+    """
+    return sum(seconds for calls, seconds, rule_times in rules.get_timing().values())
+
+
+def run(h_file, rules, repeat, libclang=None):
+    """
+    Time the phases of generating the SIP for a header, using a sip_generator.Profile. The walk excludes the time spent
+    applying the rules.
+
+    :param h_file:              The header.
+    :param rules:               The RuleSet.
+    :param repeat:              The number of runs, of which the fastest for each phase is kept.
+    :param libclang:            Optional libclang library to use.
+    :return:                    A dict of the time for each phase, in seconds.
+    """
+    best = None
+    sip_file = os.path.splitext(h_file)[0] + ".sip"
+    for i in range(repeat):
+        generator = sip_generator.SipGenerator(rules, libclang=libclang)
+        profile = sip_generator.Profile()
+        profile.attach(generator)
+        #
+        # The timing of the rules accumulates across generators, so only count what this run adds.
+        #
+        rules_start = _rules_seconds(rules)
+        start = timer()
+        body, includes = generator.create_sip(h_file, os.path.basename(h_file))
+        times = {"rules": _rules_seconds(rules) - rules_start}
+        times["parse"] = profile.phases["parse"][1]
+        times["walk"] = profile.phases["walk"][1] - times["rules"]
+        emit_start = timer()
+        sip_generator.write_sip(sip_file, body)
+        times["emit"] = timer() - emit_start
+        times["total"] = timer() - start
+        if best is None:
+            best = times
+        else:
+            best = dict((phase, min(best[phase], times[phase])) for phase in PHASES)
+    return best
+
+
+def check_snapshot(h_file, rules, work_dir, libclang=None):
+    """
+    Check that replaying the snapshot of a header generates the same SIP as walking its translation unit.
+
+    :param h_file:              The header.
+    :param rules:               The RuleSet.
+    :param work_dir:            Where to keep the snapshot.
+    :param libclang:            Optional libclang library to use.
+    :return:                    A description of any difference, or None.
+    """
+    snapshot_dir = os.path.join(work_dir, "snapshots")
+    shutil.rmtree(snapshot_dir, ignore_errors=True)
+    os.makedirs(snapshot_dir)
+    sips = []
+    for i in range(2):
+        generator = sip_generator.SipGenerator(rules, libclang=libclang, snapshot_dir=snapshot_dir)
+        body, includes = generator.create_sip(h_file, os.path.basename(h_file))
+        sips.append("".join(rules_engine.iter_fragments(body)).splitlines(True))
+    if not isinstance(generator.tu, ast_snapshot.SnapshotTU):
+        return _("The snapshot of {} was not used").format(h_file)
+    if sips[0] != sips[1]:
+        return "".join(difflib.unified_diff(sips[0], sips[1], _("parsed"), _("replayed")))
+    return None
+
+
+def _revision():
+    """
+    The revision of the generator being measured, if it is in a git checkout.
+    """
+    try:
+        with open(os.devnull, "w") as devnull:
+            revision = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                               cwd=os.path.dirname(os.path.abspath(__file__)), stderr=devnull)
+        return revision.decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(shapes, scales, repeat, rules, work_dir, libclang=None):
+    """
+    Run the benchmarks.
+
+    :param shapes:              The shapes of header to use, from SHAPES.
+    :param scales:              The sizes of header to use.
+    :param repeat:              The number of runs of each.
+    :param rules:               The RuleSet.
+    :param work_dir:            Where to write the headers and SIP files.
+    :param libclang:            Optional libclang library to use.
+    :return:                    The results, ready to be saved as JSON.
+    """
+    results = []
+    for shape in shapes:
+        for scale in scales:
+            h_file, lines = write_header(work_dir, shape, scale)
+            times = run(h_file, rules, repeat, libclang)
+            results.append({"shape": shape, "scale": scale, "lines": lines, "times": times})
+            logger.debug(_("{} {}: {}").format(shape, scale, times))
+    return {
+        "revision": _revision(),
+        "python": platform.python_version(),
+        "repeat": repeat,
+        "results": results,
+    }
+
+
+def report(results, baseline=None):
+    """
+    Print the results, compared to a baseline if there is one.
+
+    :param results:             As returned by benchmark().
+    :param baseline:            Optional earlier results to compare to.
+    """
+    baselines = {}
+    if baseline:
+        for result in baseline["results"]:
+            baselines[(result["shape"], result["scale"])] = result["times"]
+    print("{:<12}{:>7}{:>7}".format(_("shape"), _("scale"), _("lines")) + "".join("{:>17}".format(p) for p in PHASES))
+    for result in results["results"]:
+        line = "{:<12}{:>7}{:>7}".format(result["shape"], result["scale"], result["lines"])
+        old = baselines.get((result["shape"], result["scale"]))
+        for phase in PHASES:
+            cell = "{:.4f}".format(result["times"][phase])
+            if old and old.get(phase):
+                cell += " ({:+.0%})".format(result["times"][phase] / old[phase] - 1)
+            line += "{:>17}".format(cell)
+        print(line)
+
+
+def main(argv=None):
+    """
+    Time the phases of SIP generation for synthetic headers of various shapes and sizes. The phases are:
+
+        parse   Parsing the header with libclang.
+        walk    Walking the AST, excluding the time spent in rules.
+        rules   Matching and applying the rules.
+        emit    Writing the SIP file.
+
+    Unless --shape or --scale is given, every shape is generated at a scale of 100. Each time is the best of --repeat
+    runs. Save the results from one revision to compare against another.
+
+    Examples:
+
+        sip_benchmark.py --output before.json
+        sip_benchmark.py --shape defaults --scale 100 --scale 1000 --compare before.json
+        sip_benchmark.py --check-snapshots
+    """
+    if argv is None:
+        argv = sys.argv
+    parser = argparse.ArgumentParser(epilog=inspect.getdoc(main),
+                                     formatter_class=HelpFormatter)
+    parser.add_argument("-v", "--verbose", action="store_true", default=False, help=_("Enable verbose output"))
+    parser.add_argument("--shape", action="append", choices=sorted(SHAPES),
+                        help=_("Shape of header to generate, may be repeated"))
+    parser.add_argument("--scale", action="append", type=int, help=_("Size of header, may be repeated"))
+    parser.add_argument("--repeat", type=int, default=3, help=_("Number of runs of each benchmark"))
+    parser.add_argument("--project-rules", help=_("Project rules"))
+    parser.add_argument("--libclang", help=_("The libclang library to use, rather than searching for it"))
+    parser.add_argument("--work-dir",
+                        help=_("Directory to keep the headers and SIP files in, rather than a temporary one"))
+    parser.add_argument("--output", help=_("Write the results as JSON"))
+    parser.add_argument("--compare", metavar="JSON", help=_("Compare to the results of an earlier run"))
+    parser.add_argument("--check-snapshots", action="store_true", default=False,
+                        help=_("Rather than timing anything, check that replaying the snapshot of each header "
+                               "generates the same SIP as parsing it"))
+    try:
+        args = parser.parse_args(argv[1:])
+        if args.verbose:
+            logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(name)s %(levelname)s: %(message)s')
+        else:
+            logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+        shapes = args.shape or sorted(SHAPES)
+        scales = args.scale or [100]
+        baseline = None
+        if args.compare:
+            with open(args.compare, "r") as f:
+                baseline = json.load(f)
+        work_dir = args.work_dir or tempfile.mkdtemp(prefix="sip_benchmark")
+        if not os.path.isdir(work_dir):
+            os.makedirs(work_dir)
+        try:
+            if args.project_rules:
+                rules = rules_engine.rules(args.project_rules, work_dir)
+            else:
+                rules = rules_engine.Qt5Rules(work_dir)
+            if args.check_snapshots:
+                failures = 0
+                for shape in shapes:
+                    for scale in scales:
+                        h_file, lines = write_header(work_dir, shape, scale)
+                        difference = check_snapshot(h_file, rules, work_dir, args.libclang)
+                        if difference:
+                            logger.error(_("{} {}: {}").format(shape, scale, difference))
+                            failures += 1
+                return -1 if failures else 0
+            results = benchmark(shapes, scales, args.repeat, rules, work_dir, args.libclang)
+        finally:
+            if not args.work_dir:
+                shutil.rmtree(work_dir, ignore_errors=True)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=4, sort_keys=True)
+        report(results, baseline)
+    except Exception as e:
+        tbk = traceback.format_exc()
+        print(tbk)
+        return -1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -20,17 +20,31 @@
 """SIP file generator for PyKDE."""
 from __future__ import print_function
 import argparse
+import collections
+import cProfile
+import fnmatch
 import gettext
+import glob
+import hashlib
+import heapq
 import inspect
+import json
 import logging
+import mmap
+import multiprocessing
 import os
 import re
+import shutil
+import socket
 import subprocess
 import sys
+import tempfile
+import time
 import traceback
 from clang import cindex
 from clang.cindex import AccessSpecifier, CursorKind, SourceRange, StorageClass, TokenKind, TypeKind, TranslationUnit
 
+import ast_snapshot
 import rules_engine
 
 
@@ -44,22 +58,228 @@ gettext.install(__name__)
 # Keep PyCharm happy.
 _ = _
 
+timer = getattr(time, "perf_counter", time.time)
 
-def walk_directories(root, fn):
+
+def list_directory(path):
+    """
+    List a directory, using os.scandir where available to avoid a stat() per entry.
+
+    :param path:                The directory.
+    :return:                    A tuple of the subdirectories and the (non-directory) file names.
     """
-    Walk over a directory tree and for each directory, apply a function.
+    subdirs = []
+    files = []
+    if hasattr(os, "scandir"):
+        for entry in os.scandir(path):
+            if entry.is_dir():
+                subdirs.append(entry.name)
+            else:
+                files.append(entry.name)
+    else:
+        for name in os.listdir(path):
+            if os.path.isdir(os.path.join(path, name)):
+                subdirs.append(name)
+            else:
+                files.append(name)
+    return subdirs, files
+
+
+class IncludeTree(object):
+    """
+    All the directories under a set of include roots, along with the files in each one.
+
+    Walking trees such as /usr/include is slow, so the result can be kept in a cache directory and reused for as
+    long as none of the directories has changed.
+    """
+    INCLUDE_DIRECTIVE = re.compile(r'^\s*#\s*include\s*[<"]([^>"]+)[>"]', re.MULTILINE)
+
+    def __init__(self, roots, cache_dir=None):
+        """
+        Constructor.
+
+        :param roots:               The include roots.
+        :param cache_dir:           Optional directory to persist the walk in.
+        """
+        self.roots = list(roots)
+        #
+        # Directory -> (mtime, [files]).
+        #
+        self.directories = {}
+        self.files = None
+        self.file_includes = {}
+        cache_file = None
+        if cache_dir:
+            key = hashlib.sha1("\0".join(self.roots).encode("utf-8")).hexdigest()
+            cache_file = os.path.join(cache_dir, "includes-" + key + ".json")
+            if self._load(cache_file):
+                return
+        for root in self.roots:
+            self._walk(root)
+        if cache_file:
+            self._save(cache_file)
+
+    def _walk(self, root):
+        pending = [root]
+        while pending:
+            path = pending.pop()
+            subdirs, files = list_directory(path)
+            self.directories[path] = (os.stat(path).st_mtime, files)
+            pending.extend(os.path.join(path, d) for d in subdirs)
+
+    def _load(self, cache_file):
+        """
+        Load a previous walk, if there is one and no directory in it has changed. A directory's mtime changes whenever
+        an entry is added to or removed from it, so checking each one is enough to validate the whole walk.
+        """
+        try:
+            with open(cache_file, "r") as f:
+                directories = json.load(f)
+            for path, (mtime, files) in directories.items():
+                if os.stat(path).st_mtime != mtime:
+                    return False
+            #
+            # Mark it as recently used for OutputCache.trim().
+            #
+            os.utime(cache_file, None)
+        except (IOError, OSError, ValueError):
+            return False
+        self.directories = dict((k, (v[0], v[1])) for k, v in directories.items())
+        logger.debug(_("Using cached includes from {}").format(cache_file))
+        return True
+
+    def _save(self, cache_file):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(cache_file))
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.directories, f)
+        os.rename(tmp, cache_file)
+
+    def _includes_of(self, filename):
+        includes = self.file_includes.get(filename)
+        if includes is None:
+            with open(filename, "r") as f:
+                includes = IncludeTree.INCLUDE_DIRECTIVE.findall(f.read())
+            self.file_includes[filename] = includes
+        return includes
+
+    def resolve(self, h_file):
+        """
+        Find the include directories actually needed by a header, by following its #include directives through the
+        tree. Conditional includes are followed too, so the result is a (much smaller) superset.
 
-    :param root:                Tree to be walked.
-    :param fn:                  Function to apply.
-    :return: None
+        :param h_file:              The header.
+        :return:                    The roots, plus the other directories needed.
+        """
+        if self.files is None:
+            #
+            # Index every file by its basename.
+            #
+            self.files = {}
+            for path, (mtime, files) in self.directories.items():
+                for name in files:
+                    self.files.setdefault(name, []).append(path)
+        needed = set()
+        seen = set()
+        pending = [h_file]
+        while pending:
+            filename = pending.pop()
+            if filename in seen:
+                continue
+            seen.add(filename)
+            for include in self._includes_of(filename):
+                local = os.path.join(os.path.dirname(filename), include)
+                if os.path.isfile(local):
+                    pending.append(local)
+                    continue
+                suffix = os.path.dirname(include)
+                for path in self.files.get(os.path.basename(include), []):
+                    if not suffix:
+                        needed.add(path)
+                    elif path.endswith(os.sep + suffix):
+                        needed.add(path[:-len(suffix) - 1])
+                    else:
+                        continue
+                    pending.append(os.path.join(path, os.path.basename(include)))
+        return self.roots + sorted(needed.difference(self.roots))
+
+
+class SourceText(object):
+    """
+    The unpre-processed text of a source file, indexed by line so that the text of any extent is a single slice.
     """
-    names = os.listdir(root)
-    for name in names:
-        srcname = os.path.join(root, name)
-        if os.path.isdir(srcname):
-            fn(srcname)
-        if os.path.isdir(srcname):
-            walk_directories(srcname, fn)
+    MMAP_THRESHOLD = 64 * 1024
+
+    def __init__(self, filename):
+        """
+        Constructor.
+
+        :param filename:            The source file.
+        """
+        self.filename = filename
+        with open(filename, "rb") as f:
+            st = os.fstat(f.fileno())
+            self.stamp = (st.st_mtime, st.st_size)
+            if st.st_size >= SourceText.MMAP_THRESHOLD:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                buffer = f.read()
+        if buffer.find(b"\r") != -1:
+            #
+            # Use universal newlines, as libclang does. The columns in a line are not affected.
+            #
+            buffer = buffer[:].replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+        self.buffer = buffer
+        #
+        # The offset of the start of each line, plus one for the end of the text.
+        #
+        self.lines = [0]
+        end = buffer.find(b"\n")
+        while end != -1:
+            self.lines.append(end + 1)
+            end = buffer.find(b"\n", end + 1)
+        if self.lines[-1] != len(buffer):
+            self.lines.append(len(buffer))
+
+    def close(self):
+        """
+        Release the mapping of a large file, and with it the file descriptor.
+        """
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+        self.buffer = None
+
+    def is_current(self):
+        """
+        Is the indexed text still that of the file?
+        """
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return False
+        return (st.st_mtime, st.st_size) == self.stamp
+
+    def _offset(self, line, column):
+        if line < 1:
+            return 0
+        if line >= len(self.lines):
+            return self.lines[-1]
+        #
+        # Do not run past the end of the line.
+        #
+        return min(self.lines[line - 1] + column - 1, self.lines[line])
+
+    def read(self, extent):
+        """
+        Read the given range.
+
+        :param extent:              The range of text required.
+        :return:                    The text, as a single line.
+        """
+        text = self.buffer[self._offset(extent.start.line, extent.start.column):
+                           self._offset(extent.end.line, extent.end.column)]
+        if not isinstance(text, str):
+            text = text.decode("utf-8", "replace")
+        return text.replace("\n", " ")
 
 
 EXPR_KINDS = [
@@ -73,31 +293,161 @@ TEMPLATE_KINDS = [
                  ] + EXPR_KINDS
 
 
+class TypeInfo(object):
+    """
+    What the generator uses of a type.
+    """
+    __slots__ = ["spelling", "canonical_spelling", "scope"]
+
+    def __init__(self, spelling, canonical_spelling):
+        self.spelling = spelling
+        self.canonical_spelling = canonical_spelling
+        #
+        # The spelling of the type whose scope qualifies a default value, if it has been worked out.
+        #
+        self.scope = None
+
+
+class TypeCache(object):
+    """
+    The spellings and declarations of types, which recur thousands of times across the headers of a module, each
+    fetched from libclang only once.
+
+    Types from different translation units cannot be compared, so reset() is called for each one. What is worked out
+    from a type's declaration is also kept by the declaration's name, and so shared across translation units.
+    """
+    def __init__(self):
+        self.types = {}
+        #
+        # (declared type spelling, canonical spelling) -> scope spelling.
+        #
+        self.scopes = {}
+
+    def reset(self):
+        """
+        Forget the types of the last translation unit.
+        """
+        self.types = {}
+
+    def get(self, type):
+        """
+        Get what is known about a type.
+
+        :param type:                A clang.cindex.Type or SnapshotType.
+        :return:                    The TypeInfo.
+        """
+        if isinstance(type, ast_snapshot.SnapshotType):
+            key = type
+        else:
+            #
+            # A libclang type is a kind plus a pointer to the type within the translation unit.
+            #
+            key = (type._kind_id, type.data[0])
+        info = self.types.get(key)
+        if info is None:
+            info = self.types[key] = TypeInfo(type.spelling, type.get_canonical().spelling)
+        return info
+
+    def scope(self, type):
+        """
+        Get the type whose scope qualifies a default value of a type. This is the declared type, except for a QFlags
+        typedef, where it is the type of the flags.
+
+        :param type:                A clang.cindex.Type.
+        :return:                    The spelling of the type.
+        """
+        info = self.get(type)
+        if info.scope is None:
+            declaration = type.get_declaration()
+            declared = declaration.type
+            key = (declared.spelling, info.canonical_spelling)
+            scope = self.scopes.get(key)
+            if scope is None:
+                scope = key[0]
+                if declared.kind == TypeKind.TYPEDEF:
+                    isQFlags = False
+                    for member in ast_snapshot.get_children(declaration):
+                        if member.kind == CursorKind.TEMPLATE_REF and member.spelling == "QFlags":
+                            isQFlags = True
+                        if isQFlags and member.kind == CursorKind.TYPE_REF:
+                            scope = member.type.spelling
+                            break
+                self.scopes[key] = scope
+            info.scope = scope
+        return info.scope
+
+
 class SipGenerator(object):
     _libclang = None
-
-    def __init__(self, project_rules, verbose=False, dump_includes=False, dump_privates=False):
+    #
+    # The number of source files to keep the text of, for when the same headers are processed again.
+    #
+    SOURCES_KEPT = 8
+
+    def __init__(self, project_rules, verbose=False, dump_includes=False, dump_privates=False, pch_prelude=None,
+                 pch_file=None, preamble=False, include_cache=None, minimal_includes=False, libclang=None,
+                 snapshot_dir=None):
         """
         Constructor.
 
         :param project_rules:       The rules for the project.
         :param dump_includes:       Turn on diagnostics for include files.
         :param dump_privates:       Turn on diagnostics for omitted private items.
+        :param pch_prelude:         Optional list of headers (e.g. "QtCore/QtCore") to precompile once, and then
+                                    reuse for every header.
+        :param pch_file:            Where to write the precompiled prelude.
+        :param preamble:            Keep translation units, and reparse them using libclang's precompiled preamble
+                                    when the same header is processed again in a persistent process.
+        :param include_cache:       Optional directory to cache the walk of the include roots in.
+        :param minimal_includes:    Only pass the include roots, and the directories each header actually needs,
+                                    to libclang rather than every directory under the roots.
+        :param libclang:            Optional libclang library to use.
+        :param snapshot_dir:        Optional directory to keep a snapshot of each parsed header in. Headers are only
+                                    parsed again when they, or anything they include, change. Replaying a snapshot
+                                    does not need libclang.
         """
-        SipGenerator._find_libclang()
+        try:
+            SipGenerator._find_libclang(libclang)
+        except RuntimeError:
+            #
+            # Not fatal as long as the snapshots mean nothing needs parsing, see check_snapshots().
+            #
+            if not snapshot_dir:
+                raise
         self.rules = project_rules
-        self.exploded_includes = set(self.rules.includes())
-        for include_root in self.rules.includes():
-            walk_directories(include_root, lambda d: self.exploded_includes.add(d))
+        self.include_tree = IncludeTree(self.rules.includes(), include_cache)
+        self.exploded_includes = set(self.include_tree.directories)
+        self.minimal_includes = minimal_includes
         if dump_includes:
             for include in sorted(self.exploded_includes):
                 logger.debug(_("Using includes from {}").format(include))
         self.verbose = verbose
+        #
+        # Check once, rather than for every ignored cursor, whether the debug messages would go anywhere.
+        #
+        self.debug = logger.isEnabledFor(logging.DEBUG)
         self.dump_includes = dump_includes
         self.dump_privates = dump_privates
         self.diagnostics = set()
+        self.pch_prelude = pch_prelude
+        self.pch_file = pch_file
+        self.pch_args = None
+        self.pch_includes = []
+        self.preamble = preamble
+        self.tus = {}
+        self.cache = None
+        self.profile = None
+        self.index = None
         self.tu = None
+        self.in_main_file = None
         self.unpreprocessed_source = None
+        #
+        # Filename -> SourceText, reused while the file is unchanged, least recently used first.
+        #
+        self.sources = collections.OrderedDict()
+        self.types = TypeCache()
+        self.snapshot_dir = snapshot_dir
+        self.snapshot_salt = None
 
     @staticmethod
     def describe(cursor, text=None):
@@ -105,32 +455,85 @@ class SipGenerator(object):
             text = cursor.spelling
         return "{} on line {} '{}'".format(cursor.kind.name, cursor.extent.start.line, text)
 
+    @property
+    def rules(self):
+        return self._rules
+
+    @rules.setter
+    def rules(self, rules):
+        self._rules = rules
+        #
+        # Project rules may override methodcode() without the parents argument.
+        #
+        try:
+            spec = inspect.getfullargspec(rules.methodcode)
+        except AttributeError:
+            spec = inspect.getargspec(rules.methodcode)
+        self.methodcode_parents = "parents" in spec.args
+
     def create_sip(self, h_file, include_filename):
         """
         Actually convert the given source header file into its SIP equivalent.
 
         :param h_file:              The source (header) file of interest.
         :param include_filename:    The (header) to generate in the sip file.
+        :return:                    The SIP text as a list of fragments (see rules_engine.iter_fragments()), and a
+                                    callable returning the includes used.
+        """
+        self.parse(h_file)
+        #
+        # Run through the top level children in the translation unit.
+        #
+        body = self._container_get(self.tu.cursor, -1, h_file, include_filename)
+        return body, self.tu.get_includes
+
+    def parse(self, h_file):
         """
+        Read and parse the given source header file, or restore its snapshot, ready for conversion.
 
+        :param h_file:              The source (header) file of interest.
+        """
         #
         # Read in the original file.
         #
         source = h_file
-        self.unpreprocessed_source = []
-        with open(source, "rU") as f:
-            for line in f:
-                self.unpreprocessed_source.append(line)
+        text = self.sources.pop(source, None)
+        if text is not None and not text.is_current():
+            text.close()
+            text = None
+        if text is None:
+            text = SourceText(source)
+        self.sources[source] = text
+        while len(self.sources) > SipGenerator.SOURCES_KEPT:
+            self.sources.popitem(last=False)[1].close()
+        self.unpreprocessed_source = text
         #
         # Create and populate the index. To run the actual compiler in proprocess-only mode:
         #
         # ["clang-3.9"] + includes + ["-x", "c++", "-std=c++11", "-ferror-limit=0", "-D__CODE_GENERATOR__", "-E"] + [source]
         #
-        includes = ["-I" + i for i in self.exploded_includes]
-        index = cindex.Index.create()
-        self.tu = index.parse(source,
-                includes + ["-x", "c++", "-std=c++11", "-ferror-limit=0", "-D__CODE_GENERATOR__"],
-                options=TranslationUnit.PARSE_SKIP_FUNCTION_BODIES)
+        includes = self._include_flags(source)
+        self.tu = None
+        self.types.reset()
+        if self.snapshot_dir:
+            snapshot_file = self._snapshot_file(source, includes)
+            self.tu = ast_snapshot.load(snapshot_file)
+        if self.tu is not None:
+            logger.debug(_("Using snapshot {} for {}").format(snapshot_file, source))
+        elif self.preamble and source in self.tus:
+            self.tu = self.tus[source]
+            self.tu.reparse()
+        else:
+            options = TranslationUnit.PARSE_SKIP_FUNCTION_BODIES
+            if self.preamble:
+                options |= TranslationUnit.PARSE_PRECOMPILED_PREAMBLE | TranslationUnit.PARSE_CACHE_COMPLETION_RESULTS
+            self.tu = self._get_index().parse(source, self.prepare_pch() + self._compile_flags(includes),
+                                              options=options)
+            if self.preamble:
+                self.tus[source] = self.tu
+        if self.snapshot_dir and not isinstance(self.tu, ast_snapshot.SnapshotTU):
+            ast_snapshot.save(snapshot_file, self.tu, self._fn_get_parameter_default, self.dependencies())
+        self.in_main_file = ast_snapshot.main_file_filter(self.tu)
         for diag in self.tu.diagnostics:
             #
             # We expect to be run over hundreds of files. Any parsing issues are likely to be very repetitive.
@@ -154,11 +557,117 @@ class SipGenerator(object):
                 logger.debug(_("Using includes from {}").format(include))
             for include in sorted(set(self.tu.get_includes())):
                 logger.debug(_("Used includes {}").format(include.include.name))
-        #
-        # Run through the top level children in the translation unit.
-        #
-        body = self._container_get(self.tu.cursor, -1, h_file, include_filename)
-        return body, self.tu.get_includes
+
+    @staticmethod
+    def _compile_flags(includes):
+        return includes + ["-x", "c++", "-std=c++11", "-ferror-limit=0", "-D__CODE_GENERATOR__"]
+
+    def _include_flags(self, source):
+        if self.minimal_includes:
+            return ["-I" + i for i in self.include_tree.resolve(source)]
+        return ["-I" + i for i in sorted(self.exploded_includes)]
+
+    def _snapshot_file(self, source, includes):
+        """
+        The snapshot of a header depends on the compiler settings, and on the generator code which records it.
+        """
+        if self.snapshot_salt is None:
+            hasher = hashlib.sha1()
+            for module in [__file__, ast_snapshot.__file__]:
+                with open(os.path.splitext(module)[0] + ".py", "rb") as f:
+                    hasher.update(f.read())
+            hasher.update("\0".join(self.pch_prelude or []).encode("utf-8"))
+            self.snapshot_salt = hasher.hexdigest()
+        key = "\0".join([self.snapshot_salt, os.path.abspath(source)] + self._compile_flags(includes))
+        return os.path.join(self.snapshot_dir, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".ast")
+
+    def check_snapshots(self, sources):
+        """
+        Without libclang, every header must be replayed from its snapshot. Check that up front, rather than failing
+        part way through a run.
+
+        :param sources:             The headers to be processed, or None if they are not known in advance.
+        """
+        if SipGenerator._libclang:
+            return
+        if sources is None or not self.snapshot_dir:
+            raise RuntimeError(_("Cannot find libclang"))
+        for source in sources:
+            if ast_snapshot.load(self._snapshot_file(source, self._include_flags(source))) is None:
+                raise RuntimeError(_("Cannot find libclang, and there is no usable snapshot of {}").format(source))
+
+    def _get_index(self):
+        if not SipGenerator._libclang:
+            raise RuntimeError(_("Cannot find libclang"))
+        if not self.index:
+            self.index = cindex.Index.create()
+        return self.index
+
+    def prepare_pch(self):
+        """
+        Build the precompiled prelude, if one was asked for and it has not already been built.
+
+        :return:                    The extra compiler arguments needed to use the precompiled prelude.
+        """
+        if self.pch_args is not None:
+            return self.pch_args
+        self.pch_args = []
+        if not self.pch_prelude:
+            return self.pch_args
+        prelude = os.path.splitext(self.pch_file)[0] + ".h"
+        with open(prelude, "w") as f:
+            for header in self.pch_prelude:
+                if header[0] not in "<\"":
+                    header = "<" + header + ">"
+                f.write("#include {}\n".format(header))
+        includes = self._include_flags(prelude)
+        tu = self._get_index().parse(prelude, self._compile_flags(includes),
+                                     options=TranslationUnit.PARSE_INCOMPLETE |
+                                     TranslationUnit.PARSE_SKIP_FUNCTION_BODIES)
+        try:
+            tu.save(self.pch_file)
+        except cindex.TranslationUnitSaveError as e:
+            #
+            # Not fatal, we just go slower.
+            #
+            logger.warn(_("Cannot precompile {}, continuing without it: {}").format(prelude, e))
+            return self.pch_args
+        logger.debug(_("Precompiled {} into {}").format(prelude, self.pch_file))
+        self.pch_args = ["-include-pch", self.pch_file]
+        self.pch_includes = sorted(set(i.include.name for i in tu.get_includes()))
+        return self.pch_args
+
+    def fingerprint(self):
+        """
+        Summarise everything apart from the header itself which affects the generated output: the generator and
+        rules code, and the compiler settings.
+
+        :return:                    A string.
+        """
+        sources = [__file__, ast_snapshot.__file__, rules_engine.__file__, inspect.getsourcefile(type(self.rules))]
+        hasher = hashlib.sha1()
+        for source in sources:
+            source = os.path.splitext(source)[0] + ".py"
+            with open(source, "rb") as f:
+                hasher.update(f.read())
+        flags = self._compile_flags(sorted(self.exploded_includes)) + (self.pch_prelude or [])
+        flags.append(str(self.minimal_includes))
+        hasher.update("\0".join(flags + [str(self.verbose)]).encode("utf-8"))
+        return hasher.hexdigest()
+
+    def dependencies(self):
+        """
+        The files read to process the last header: itself, everything it included and anything in the precompiled
+        prelude.
+
+        :return:                    A sorted list of filenames.
+        """
+        if isinstance(self.tu, ast_snapshot.SnapshotTU):
+            return self.tu.dependencies
+        deps = set(i.include.name for i in self.tu.get_includes())
+        deps.update(self.pch_includes)
+        deps.add(self.tu.spelling)
+        return sorted(deps)
 
     CONTAINER_SKIPPABLE_UNEXPOSED_DECL = re.compile("_DECLARE_PRIVATE|friend|;")
     CONTAINER_SKIPPABLE_ATTR = re.compile("_EXPORT")
@@ -166,14 +675,16 @@ class SipGenerator(object):
     VAR_SKIPPABLE_ATTR = re.compile("_EXPORT")
     TYPEDEF_SKIPPABLE_ATTR = re.compile("_EXPORT")
 
-    def _container_get(self, container, level, h_file, include_filename):
+    def _container_get(self, container, level, h_file, include_filename, scope=()):
         """
         Generate the (recursive) translation for a class or namespace.
 
         :param container:           A class or namespace.
         :param h_file:              Name of header file being processed.
         :param level:               Recursion level controls indentation.
-        :return:                    A string.
+        :param scope:               The spellings of the container's parents, outermost first.
+        :return:                    A list of fragments. Each is a string, or a nested list for a nested container,
+                                    so that the text of nested containers is never copied into that of the outer ones.
         """
 
         def skippable_attribute(member, text):
@@ -184,40 +695,53 @@ class SipGenerator(object):
             :param text:            The raw source corresponding to the region of member.
             """
             if text.find("_DEPRECATED") != -1:
-                sip["annotations"].add("Deprecated")
+                sip.annotations.add("Deprecated")
                 return True
             if SipGenerator.CONTAINER_SKIPPABLE_ATTR.search(text):
                 return True
-            SipGenerator._report_ignoring(container, member, text)
+            self._report_ignoring(container, member, text)
 
-        sip = {
-            "name": container.displayname,
-            "annotations": set()
-        }
+        def scope_of(member):
+            """
+            The scope of a member is normally that of its container, but out-of-line definitions are the exception.
+
+            :param member:          The member.
+            :return:                The spellings of the member's parents, outermost first.
+            """
+            parent = member.semantic_parent
+            if parent is not None and parent == container:
+                return member_scope
+            return SipGenerator._scope(member)
+
+        if level < 0:
+            member_scope = ()
+        else:
+            member_scope = scope + (container.spelling,)
+        sip = rules_engine.ContainerItem(container.displayname)
         name = container.displayname
         if container.access_specifier == AccessSpecifier.PRIVATE:
             if self.dump_privates:
                 logger.debug("Ignoring private {}".format(SipGenerator.describe(container)))
-            return ""
-        body = ""
+            return []
+        body = []
         base_specifiers = []
         template_type_parameters = []
-        for member in container.get_children():
+        for member in ast_snapshot.get_children(container):
             #
             # Only emit items in the translation unit.
             #
-            if member.location.file.name != self.tu.spelling:
+            if not self.in_main_file(member):
                 continue
             decl = ""
             if member.kind in [CursorKind.CXX_METHOD, CursorKind.FUNCTION_DECL, CursorKind.FUNCTION_TEMPLATE,
                                CursorKind.CONSTRUCTOR, CursorKind.DESTRUCTOR, CursorKind.CONVERSION_FUNCTION]:
-                decl = self._fn_get(container, member, level + 1)
+                decl = self._fn_get(container, member, level + 1, self._fqn(scope_of(member)))
             elif member.kind == CursorKind.ENUM_DECL:
                 decl = self._enum_get(container, member, level + 1) + ";\n"
             elif member.kind == CursorKind.CXX_ACCESS_SPEC_DECL:
                 decl = self._get_access_specifier(member, level + 1)
             elif member.kind == CursorKind.TYPEDEF_DECL:
-                decl = self._typedef_get(container, member, level + 1)
+                decl = self._typedef_get(container, member, level + 1, self._fqn(scope_of(member)))
             elif member.kind == CursorKind.CXX_BASE_SPECIFIER:
                 #
                 # Strip off the leading "class". Except for TypeKind.UNEXPOSED...
@@ -228,11 +752,11 @@ class SipGenerator(object):
             elif member.kind == CursorKind.TEMPLATE_NON_TYPE_PARAMETER:
                 template_type_parameters.append(member.type.spelling + " " + member.displayname)
             elif member.kind in [CursorKind.VAR_DECL, CursorKind.FIELD_DECL]:
-                decl = self._var_get(container, member, level + 1)
+                decl = self._var_get(container, member, level + 1, self._fqn(scope_of(member)))
             elif member.kind in [CursorKind.NAMESPACE, CursorKind.CLASS_DECL,
                                  CursorKind.CLASS_TEMPLATE, CursorKind.CLASS_TEMPLATE_PARTIAL_SPECIALIZATION,
                                  CursorKind.STRUCT_DECL, CursorKind.UNION_DECL]:
-                decl = self._container_get(member, level + 1, h_file, include_filename)
+                decl = self._container_get(member, level + 1, h_file, include_filename, scope_of(member))
             elif member.kind in TEMPLATE_KINDS + [CursorKind.USING_DECLARATION, CursorKind.USING_DIRECTIVE,
                                                   CursorKind.CXX_FINAL_ATTR]:
                 #
@@ -249,21 +773,21 @@ class SipGenerator(object):
                     if skippable_attribute(member, text):
                         pass
                     else:
-                        decl = self._unexposed_get(container, member, text, level + 1)
+                        decl = self._unexposed_get(container, member, text, level + 1, self._fqn(scope_of(member)))
                 elif member.kind == CursorKind.UNEXPOSED_DECL:
                     if SipGenerator.CONTAINER_SKIPPABLE_UNEXPOSED_DECL.search(text):
                         pass
                     else:
-                        decl = self._unexposed_get(container, member, text, level + 1)
+                        decl = self._unexposed_get(container, member, text, level + 1, self._fqn(scope_of(member)))
                 else:
-                    SipGenerator._report_ignoring(container, member)
+                    self._report_ignoring(container, member)
 
             def isSpecialCtor(member):
                 if member.kind != CursorKind.CONSTRUCTOR:
                     return False
                 numParams = 0
                 hasSelfType = False
-                for child in member.get_children():
+                for child in ast_snapshot.get_children(member):
                     numParams += 1
                     if child.kind == CursorKind.PARM_DECL:
                         paramType = child.type.spelling
@@ -286,19 +810,19 @@ class SipGenerator(object):
             if decl:
                 if self.verbose:
                     pad = " " * ((level + 1) * 4)
-                    body += pad + "// {}\n".format(SipGenerator.describe(member))
-                body += decl
+                    body.append(pad + "// {}\n".format(SipGenerator.describe(member)))
+                body.append(decl)
         #
         # Empty containers are still useful if they provide namespaces or forward declarations.
         #
         if not body and level >= 0:
-            body = "\n"
+            body = ["\n"]
             text = self._read_source(container.extent)
             if not text.endswith("}"):
                 #
                 # Forward declaration.
                 #
-                sip["annotations"].add("External")
+                sip.annotations.add("External")
         if body and level >= 0:
             #
             # There does not seem to be an obvious way to tell a class from a struct. That should matter...
@@ -318,34 +842,63 @@ class SipGenerator(object):
             #
             # Flesh out the SIP context for the rules engine.
             #
-            sip["template_parameters"] = ", ".join(template_type_parameters)
-            sip["decl"] = container_type
-            sip["base_specifiers"] = ", ".join(base_specifiers)
-            sip["body"] = body
-            self.rules.container_rules().apply(container, sip)
+            sip.template_parameters = ", ".join(template_type_parameters)
+            sip.decl = container_type
+            sip.base_specifiers = ", ".join(base_specifiers)
+            #
+            # The rules engine only joins the fragments into a string if a rule needs to see it.
+            #
+            sip.body = body
+            self.rules.container_rules().apply(container, sip, self._fqn(scope))
             pad = " " * (level * 4)
-            if sip["name"]:
-                decl = pad + sip["decl"]
-                if "External" in sip["annotations"]:
+            if sip.name:
+                decl = pad + sip.decl
+                if "External" in sip.annotations:
                     #
                     # SIP /External/ does not seem to work as one might wish. Suppress.
                     #
-                    body = decl + " /External/;\n"
-                    body = pad + "// Discarded {}\n".format(SipGenerator.describe(container))
+                    body = [decl + " /External/;\n"]
+                    body = [pad + "// Discarded {}\n".format(SipGenerator.describe(container))]
                 else:
-                    if sip["base_specifiers"]:
-                        decl += ": " + sip["base_specifiers"]
-                    if sip["annotations"]:
-                        decl += " /" + ",".join(sip["annotations"]) + "/"
-                    if sip["template_parameters"]:
-                        decl = pad + "template <" + sip["template_parameters"] + ">\n" + decl
+                    if sip.base_specifiers:
+                        decl += ": " + sip.base_specifiers
+                    if sip.annotations:
+                        decl += " /" + ",".join(sip.annotations) + "/"
+                    if sip.template_parameters:
+                        decl = pad + "template <" + sip.template_parameters + ">\n" + decl
                     decl += "\n" + pad + "{\n"
                     decl += "%TypeHeaderCode\n#include <{}>\n%End\n".format(include_filename)
-                    body = decl + sip["body"] + pad + "};\n"
+                    body = [decl, sip.body, pad + "};\n"]
             else:
-                body = pad + "// Discarded {}\n".format(SipGenerator.describe(container))
+                body = [pad + "// Discarded {}\n".format(SipGenerator.describe(container))]
         return body
 
+    def _fqn(self, scope):
+        """
+        The fully-qualified name used by the rules engine for the given parents.
+
+        :param scope:               The spellings of the parents, outermost first.
+        :return:                    The "::"-joined spellings, or the basename of the translation unit at the top level.
+        """
+        if scope:
+            return "::".join(scope)
+        return os.path.basename(self.tu.spelling)
+
+    @staticmethod
+    def _scope(cursor):
+        """
+        Walk up the semantic parents of a cursor, for when the caller cannot supply them.
+
+        :param cursor:              The cursor.
+        :return:                    The spellings of the cursor's parents, outermost first.
+        """
+        scope = []
+        parent = cursor.semantic_parent
+        while parent and parent.kind != CursorKind.TRANSLATION_UNIT:
+            scope.append(parent.spelling)
+            parent = parent.semantic_parent
+        return tuple(reversed(scope))
+
     def _get_access_specifier(self, member, level):
         """
         In principle, we just want member.access_specifier.name.lower(), except that we need to handle:
@@ -371,23 +924,25 @@ class SipGenerator(object):
         return decl
 
     def _enum_get(self, container, enum, level):
-        pad = " " * (level * 4)
-        decl = pad + "enum {} {{\n".format(enum.displayname or "__enum{}".format(enum.extent.start.line))
-        enumerations = []
-        for enum in enum.get_children():
-            enumerations.append(pad + "    {}".format(enum.displayname))
+        sip = rules_engine.EnumItem(enum.displayname or "__enum{}".format(enum.extent.start.line))
+        sip.enumerations = []
+        for enum in ast_snapshot.get_children(enum):
+            sip.enumerations.append(enum.displayname)
             assert enum.kind == CursorKind.ENUM_CONSTANT_DECL
-        decl += ",\n".join(enumerations) + "\n"
+        pad = " " * (level * 4)
+        decl = pad + "enum {} {{\n".format(sip.name)
+        decl += ",\n".join(pad + "    " + e for e in sip.enumerations) + "\n"
         decl += pad + "}"
         return decl
 
-    def _fn_get(self, container, function, level):
+    def _fn_get(self, container, function, level, parents=None):
         """
         Generate the translation for a function.
 
         :param container:           A class or namespace.
         :param function:            The function object.
         :param level:               Recursion level controls indentation.
+        :param parents:             The FQN of the function's parents, if known.
         :return:                    A string.
         """
 
@@ -399,38 +954,35 @@ class SipGenerator(object):
             :param text:            The raw source corresponding to the region of member.
             """
             if text.find("_DEPRECATED") != -1:
-                sip["annotations"].add("Deprecated")
+                sip.annotations.add("Deprecated")
                 return True
             if SipGenerator.FN_SKIPPABLE_ATTR.search(text):
                 return True
-            SipGenerator._report_ignoring(function, member, text)
+            self._report_ignoring(function, member, text)
 
-        sip = {
-            "name": function.spelling,
-            "annotations": set()
-        }
+        if parents is None:
+            parents = self._fqn(SipGenerator._scope(function))
+        sip = rules_engine.FunctionItem(function.spelling)
         parameters = []
         template_type_parameters = []
-        for child in function.get_children():
+        for child in ast_snapshot.get_children(function):
             if child.kind == CursorKind.PARM_DECL:
                 parameter = child.displayname or "__{}".format(len(parameters))
                 #
                 # So far so good, but we need any default value.
                 #
-                decl = "{} {}".format(child.type.spelling, parameter)
+                type_info = self.types.get(child.type)
+                decl = "{} {}".format(type_info.spelling, parameter)
                 decl = decl.replace("* ", "*").replace("& ", "&")
-                child_sip = {
-                    "name": parameter,
-                    "decl": "{} {}".format(child.type.get_canonical().spelling, parameter),
-                    "init": self._fn_get_parameter_default(function, child),
-                    "annotations": set()
-                }
-                self.rules.parameter_rules().apply(container, function, child, child_sip)
-                decl = child_sip["decl"]
-                if child_sip["annotations"]:
-                    decl += " /" + ",".join(child_sip["annotations"]) + "/"
-                if child_sip["init"]:
-                    decl += " = " + child_sip["init"]
+                child_sip = rules_engine.ParameterItem(parameter)
+                child_sip.decl = "{} {}".format(type_info.canonical_spelling, parameter)
+                child_sip.init = self._fn_get_parameter_default(function, child)
+                self.rules.parameter_rules().apply(container, function, child, child_sip, parents)
+                decl = child_sip.decl
+                if child_sip.annotations:
+                    decl += " /" + ",".join(child_sip.annotations) + "/"
+                if child_sip.init:
+                    decl += " = " + child_sip.init
                 parameters.append(decl)
             elif child.kind in [CursorKind.COMPOUND_STMT, CursorKind.CXX_OVERRIDE_ATTR,
                                 CursorKind.MEMBER_REF, CursorKind.DECL_REF_EXPR, CursorKind.CALL_EXPR] + TEMPLATE_KINDS:
@@ -455,51 +1007,49 @@ class SipGenerator(object):
                                                                                                                  text):
                     pass
                 else:
-                    SipGenerator._report_ignoring(function, child)
+                    self._report_ignoring(function, child)
         #
         # Flesh out the SIP context for the rules engine.
         #
-        sip["template_parameters"] = template_type_parameters
+        sip.template_parameters = template_type_parameters
         if function.kind in [CursorKind.CONSTRUCTOR, CursorKind.DESTRUCTOR]:
-            sip["fn_result"] = ""
+            sip.fn_result = ""
         else:
-            sip["fn_result"] = function.result_type.spelling
-        sip["decl"] = parameters
-        sip["prefix"], sip["suffix"] = self._fn_get_keywords(function)
-        self.rules.function_rules().apply(container, function, sip)
+            sip.fn_result = function.result_type.spelling
+        sip.decl = parameters
+        sip.prefix, sip.suffix = self._fn_get_keywords(function)
+        self.rules.function_rules().apply(container, function, sip, parents)
         pad = " " * (level * 4)
-        if sip["name"]:
+        if sip.name:
             #
             # Any method-related code (%MethodCode as well as %VirtualCatcherCode and %VirtualCallCode)?
             #
-            self.rules.methodcode(function, sip)
-            sip["template_parameters"] = ", ".join(sip["template_parameters"])
-            if not isinstance(sip["decl"], str):
-                sip["decl"] = ", ".join(sip["decl"])
-            sip["annotations"] = ",".join(sip["annotations"])
-            decl = sip["name"] + "(" + sip["decl"] + ")"
-            if sip["decl2"]:
-                if not isinstance(sip["decl2"], str):
-                    sip["decl2"] = ", ".join(sip["decl2"])
+            if self.methodcode_parents:
+                self.rules.methodcode(function, sip, parents)
+            else:
+                self.rules.methodcode(function, sip)
+            template_parameters = sip.joined("template_parameters")
+            decl = sip.name + "(" + sip.joined("decl") + ")"
+            if sip.decl2:
                 decl += "\n    " + pad + "["
-                if sip["fn_result2"]:
-                    if sip["fn_result2"][-1] in "*&":
-                        decl += sip["fn_result2"]
+                if sip.fn_result2:
+                    if sip.fn_result2[-1] in "*&":
+                        decl += sip.fn_result2
                     else:
-                        decl += sip["fn_result2"] + " "
-                decl += "(" + sip["decl2"] + ")]"
-            if sip["fn_result"]:
-                if sip["fn_result"][-1] in "*&":
-                    decl = sip["fn_result"] + decl
+                        decl += sip.fn_result2 + " "
+                decl += "(" + sip.joined("decl2") + ")]"
+            if sip.fn_result:
+                if sip.fn_result[-1] in "*&":
+                    decl = sip.fn_result + decl
                 else:
-                    decl = sip["fn_result"] + " " + decl
-            decl = pad + sip["prefix"] + decl + sip["suffix"]
-            if sip["annotations"]:
-                decl += " /" + sip["annotations"] + "/"
-            if sip["template_parameters"]:
-                decl = pad + "template <" + sip["template_parameters"] + ">\n" + decl
+                    decl = sip.fn_result + " " + decl
+            decl = pad + sip.prefix + decl + sip.suffix
+            if sip.annotations:
+                decl += " /" + ",".join(sip.annotations) + "/"
+            if template_parameters:
+                decl = pad + "template <" + template_parameters + ">\n" + decl
             decl += ";\n"
-            decl += sip["code"]
+            decl += sip.code
         else:
             decl = pad + "// Discarded {}\n".format(SipGenerator.describe(function))
         return decl
@@ -512,13 +1062,13 @@ class SipGenerator(object):
         :return:                            String containing the template template parameter.
         """
         template_type_parameters = []
-        for member in container.get_children():
+        for member in ast_snapshot.get_children(container):
             if member.kind == CursorKind.TEMPLATE_TYPE_PARAMETER:
                 template_type_parameters.append("typename")
             elif member.kind == CursorKind.TEMPLATE_TEMPLATE_PARAMETER:
                 template_type_parameters.append(self._template_template_param_get(member))
             else:
-                SipGenerator._report_ignoring(container, member)
+                self._report_ignoring(container, member)
         template_type_parameters = "template <" + (", ".join(template_type_parameters)) + "> class " + \
                                    container.displayname
         return template_type_parameters
@@ -556,9 +1106,13 @@ class SipGenerator(object):
             1. Run the lexer from "here" to the end of the file, bailing out when we see the ","
             or a ")" marking the end.
             2. Watch for the assignment.
+
+        A snapshot records the value found when the header was parsed.
         """
+        if isinstance(parameter, ast_snapshot.SnapshotCursor):
+            return parameter.default_value
 
-        for member in parameter.get_children():
+        for member in ast_snapshot.get_children(parameter):
             if member.kind.is_expression():
                 value = ""
                 for exm in member.get_tokens():
@@ -567,16 +1121,7 @@ class SipGenerator(object):
                 if (value.startswith("=")):
                     value = "0)" # HACK: Something strange happening in kitemmodels
 
-                parameterType = parameter.type.get_declaration().type
-
-                if (parameter.type.get_declaration().type.kind == TypeKind.TYPEDEF):
-                    isQFlags = False
-                    for member in parameter.type.get_declaration().get_children():
-                        if member.kind == CursorKind.TEMPLATE_REF and member.spelling == "QFlags":
-                            isQFlags = True
-                        if isQFlags and member.kind == CursorKind.TYPE_REF:
-                            parameterType = member.type
-                            break
+                parameterType = self.types.scope(parameter.type)
 
                 if not value:
                     # QStringLiteral case
@@ -587,26 +1132,30 @@ class SipGenerator(object):
                     was_punctuated = True
                     default_value = None
                     for token in self.tu.get_tokens(extent=possible_extent):
-                        if bracket_level <= 0 and token.spelling in [",", ")", ";"]:
+                        #
+                        # Each access to the spelling is another trip through libclang.
+                        #
+                        spelling = token.spelling
+                        if bracket_level <= 0 and spelling in [",", ")", ";"]:
                             found_end = True
                             break
-                        elif token.spelling == "(":
+                        elif spelling == "(":
                             was_punctuated = True
                             bracket_level += 1
-                            text += token.spelling
-                        elif token.spelling == ")":
+                            text += spelling
+                        elif spelling == ")":
                             was_punctuated = True
                             bracket_level -= 1
-                            text += token.spelling
+                            text += spelling
                         elif token.kind == TokenKind.PUNCTUATION:
                             was_punctuated = True
-                            text += token.spelling
-                            if token.spelling == "=" and default_value is None:
+                            text += spelling
+                            if spelling == "=" and default_value is None:
                                 default_value = len(text)
                         else:
                             if not was_punctuated:
                                 text += " "
-                            text += token.spelling
+                            text += spelling
                             was_punctuated = False
                     if not found_end and text or not default_value:
                         RuntimeError(_("No end found for {}::{}, '{}'").format(function.spelling, parameter.spelling, text))
@@ -614,21 +1163,22 @@ class SipGenerator(object):
                 else:
                     value = value[:-1]
 
-                if "::" in parameterType.spelling and value != "0":
-                    prefix = parameterType.spelling.rsplit("::", 1)[0]
+                if "::" in parameterType and value != "0":
+                    prefix = parameterType.rsplit("::", 1)[0]
                     if "::" in value:
                         value = value.rsplit("::", 1)[1]
                     value = prefix + "::" + value
                 return value
         return ""
 
-    def _typedef_get(self, container, typedef, level):
+    def _typedef_get(self, container, typedef, level, parents=None):
         """
         Generate the translation for a typedef.
 
         :param container:           A class or namespace.
         :param typedef:             The typedef object.
         :param level:               Recursion level controls indentation.
+        :param parents:             The FQN of the typedef's parents, if known.
         :return:                    A string.
         """
         def skippable_attribute(member, text):
@@ -639,19 +1189,16 @@ class SipGenerator(object):
             :param text:            The raw source corresponding to the region of member.
             """
             if text.find("_DEPRECATED") != -1:
-                sip["annotations"].add("Deprecated")
+                sip.annotations.add("Deprecated")
                 return True
             if SipGenerator.TYPEDEF_SKIPPABLE_ATTR.search(text):
                 return True
-            SipGenerator._report_ignoring(typedef, member, text)
+            self._report_ignoring(typedef, member, text)
 
-        sip = {
-            "name": typedef.displayname,
-            "annotations": set()
-        }
+        sip = rules_engine.TypedefItem(typedef.displayname)
         args = []
         result_type = ""
-        for child in typedef.get_children():
+        for child in ast_snapshot.get_children(typedef):
             if child.kind == CursorKind.TEMPLATE_REF:
                 result_type = child.displayname
             elif child.kind == CursorKind.TYPE_REF:
@@ -700,85 +1247,85 @@ class SipGenerator(object):
                                                                                                                  text):
                     pass
                 else:
-                    SipGenerator._report_ignoring(typedef, child)
+                    self._report_ignoring(typedef, child)
         #
         # Flesh out the SIP context for the rules engine.
         #
-        sip["fn_result"] = ""
+        sip.fn_result = ""
         if typedef.underlying_typedef_type.kind == TypeKind.MEMBERPOINTER:
-            sip["fn_result"] = result_type
-            sip["decl"] = ", ".join(args)
+            sip.fn_result = result_type
+            sip.decl = ", ".join(args)
         elif typedef.underlying_typedef_type.kind == TypeKind.RECORD:
-            sip["decl"] = result_type
+            sip.decl = result_type
         else:
-            sip["decl"] = typedef.underlying_typedef_type.spelling
-        sip["args"] = args
+            sip.decl = typedef.underlying_typedef_type.spelling
+        sip.args = args
         #
         # Working out if a typedef is for a function pointer seems hard if not impossible in many cases. For such
         # cases, the only recourse right now is the following heristic (maybe it is safer to put this in the rules
         # engine?)
         #
         if typedef.underlying_typedef_type.kind != TypeKind.MEMBERPOINTER:
-            if sip["decl"].endswith(")"):
-                parts = sip["decl"].split("(*)", 2)
+            if sip.decl.endswith(")"):
+                parts = sip.decl.split("(*)", 2)
                 if len(parts) == 2 and parts[1].startswith("("):
-                    sip["fn_result"] = parts[0]
-                    sip["decl"] = parts[1][1:-1]
-        self.rules.typedef_rules().apply(container, typedef, sip)
+                    sip.fn_result = parts[0]
+                    sip.decl = parts[1][1:-1]
+        self.rules.typedef_rules().apply(container, typedef, sip, parents)
         #
         # Now the rules have run, add any prefix/suffix.
         #
         pad = " " * (level * 4)
-        if sip["name"]:
-            if sip["fn_result"]:
-                decl = pad + "typedef {}(*{})({})".format(sip["fn_result"], sip["name"], sip["decl"])
+        if sip.name:
+            if sip.fn_result:
+                decl = pad + "typedef {}(*{})({})".format(sip.fn_result, sip.name, sip.decl)
                 decl = decl.replace("* ", "*").replace("& ", "&")
             else:
-                decl = pad + "typedef {} {}".format(sip["decl"], sip["name"])
+                decl = pad + "typedef {} {}".format(sip.decl, sip.name)
             #
             # SIP does not support deprecation of typedefs.
             #
-            sip["annotations"].discard("Deprecated")
-            if sip["annotations"]:
-                decl += " /" + ",".join(sip["annotations"]) + "/"
+            sip.annotations.discard("Deprecated")
+            if sip.annotations:
+                decl += " /" + ",".join(sip.annotations) + "/"
             decl += ";\n"
         else:
             decl = pad + "// Discarded {}\n".format(SipGenerator.describe(typedef))
         return decl
 
-    def _unexposed_get(self, container, unexposed, text, level):
+    def _unexposed_get(self, container, unexposed, text, level, parents=None):
         """
         The parser does not seem to provide access to the complete text of an unexposed decl.
 
             1. Run the lexer from "here" to the end of the outer scope, bailing out when we see the ";"
             or a "{" marking the end.
+
+        :param parents:             The FQN of the unexposed item's parents, if known.
         """
-        sip = {
-            "name": unexposed.displayname,
-            "annotations": set()
-        }
+        sip = rules_engine.UnexposedItem(unexposed.displayname)
         #
         # Flesh out the SIP context for the rules engine.
         #
-        sip["decl"] = text
-        self.rules.unexposed_rules().apply(container, unexposed, sip)
+        sip.decl = text
+        self.rules.unexposed_rules().apply(container, unexposed, sip, parents)
         #
         # Now the rules have run, add any prefix/suffix.
         #
         pad = " " * (level * 4)
-        if sip["name"]:
-            decl = pad + sip["decl"] + "\n"
+        if sip.name:
+            decl = pad + sip.decl + "\n"
         else:
             decl = pad + "// Discarded {}\n".format(SipGenerator.describe(unexposed))
         return decl
 
-    def _var_get(self, container, variable, level):
+    def _var_get(self, container, variable, level, parents=None):
         """
         Generate the translation for a variable.
 
         :param container:           A class or namespace.
         :param variable:            The variable object.
         :param level:               Recursion level controls indentation.
+        :param parents:             The FQN of the variable's parents, if known.
         :return:                    A string.
         """
 
@@ -791,13 +1338,10 @@ class SipGenerator(object):
             """
             if SipGenerator.VAR_SKIPPABLE_ATTR.search(text):
                 return True
-            SipGenerator._report_ignoring(container, member, text)
+            self._report_ignoring(container, member, text)
 
-        sip = {
-            "name": variable.spelling,
-            "annotations": set()
-        }
-        for child in variable.get_children():
+        sip = rules_engine.VariableItem(variable.spelling)
+        for child in ast_snapshot.get_children(variable):
             if child.kind in TEMPLATE_KINDS + [CursorKind.STRUCT_DECL, CursorKind.UNION_DECL]:
                 #
                 # Ignore:
@@ -810,23 +1354,23 @@ class SipGenerator(object):
                 if child.kind == CursorKind.VISIBILITY_ATTR and skippable_attribute(child, text):
                     pass
                 else:
-                    SipGenerator._report_ignoring(variable, child)
+                    self._report_ignoring(variable, child)
         #
         # Flesh out the SIP context for the rules engine.
         #
         decl = "{} {}".format(variable.type.spelling, variable.spelling)
         decl = decl.replace("* ", "*").replace("& ", "&")
-        sip["decl"] = decl
-        self.rules.variable_rules().apply(container, variable, sip)
+        sip.decl = decl
+        self.rules.variable_rules().apply(container, variable, sip, parents)
         #
         # Now the rules have run, add any prefix/suffix.
         #
         pad = " " * (level * 4)
-        if sip["name"]:
+        if sip.name:
             prefix = self._var_get_keywords(variable)
-            decl = prefix + sip["decl"]
-            if sip["annotations"]:
-                decl += " /" + ",".join(sip["annotations"]) + "/"
+            decl = prefix + sip.decl
+            if sip.annotations:
+                decl += " /" + ",".join(sip.annotations) + "/"
             #
             # SIP does not support protected variables, so we promote to public.
             #
@@ -861,42 +1405,805 @@ class SipGenerator(object):
 
         :param extent:              The range of text required.
         """
-        extract = self.unpreprocessed_source[extent.start.line - 1:extent.end.line]
-        if extent.start.line == extent.end.line:
-            extract[0] = extract[0][extent.start.column - 1:extent.end.column - 1]
-        else:
-            extract[0] = extract[0][extent.start.column - 1:]
-            extract[-1] = extract[-1][:extent.end.column - 1]
-        #
-        # Return a single line of text.
-        #
-        return "".join(extract).replace("\n", " ")
+        return self.unpreprocessed_source.read(extent)
+
+    LIBCLANG_PATTERNS = ["/usr/lib*/libclang*.so*", "/usr/lib/*-linux-gnu/libclang*.so*",
+                         "/usr/lib*/llvm*/lib/libclang*.so*", "/usr/local/lib*/libclang*.so*"]
+    LIBCLANG_NAME = re.compile(r"^libclang(-[0-9.]+)?\.so(\.[0-9.]+)?$")
+    LIBCLANG_VERSION = re.compile(r"(?:llvm-|libclang-|\.so\.)([0-9]+(?:\.[0-9]+)*)")
+    LDSO_CACHE = "/etc/ld.so.cache"
 
     @staticmethod
-    def _find_libclang():
-        """"
-        Find the libclang.so to alow us to initialise the system.
+    def _libclang_version(path):
         """
-        if not SipGenerator._libclang:
-            lines = subprocess.check_output(["/sbin/ldconfig", "-p"])
+        The best guess at the LLVM version of a libclang, from names like /usr/lib/llvm-3.9/lib/libclang.so.1 or
+        libclang-3.8.so.1.
+        """
+        versions = [tuple(int(i) for i in v.split(".")) for v in SipGenerator.LIBCLANG_VERSION.findall(path)]
+        return max(versions or [()])
+
+    @staticmethod
+    def _libclang_cache_file():
+        cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+        return os.path.join(cache_home, "sip_generator", "libclang.json")
+
+    @staticmethod
+    def _libclang_stamp(path):
+        """
+        What we check to see if a cached libclang location is still good: the library itself and the dynamic linker
+        cache, which is updated whenever libraries are (un)installed.
+        """
+        stamp = []
+        for filename in [path, SipGenerator.LDSO_CACHE]:
+            try:
+                st = os.stat(filename)
+                stamp.append([st.st_mtime, st.st_size])
+            except OSError:
+                stamp.append(None)
+        return stamp
+
+    @staticmethod
+    def _search_libclang():
+        """
+        Look for the highest version of libclang in the usual places, only falling back to asking ldconfig if
+        nothing is found.
+        """
+        candidates = set()
+        for pattern in SipGenerator.LIBCLANG_PATTERNS:
+            for path in glob.glob(pattern):
+                if SipGenerator.LIBCLANG_NAME.match(os.path.basename(path)):
+                    candidates.add(os.path.realpath(path))
+        if not candidates:
+            try:
+                lines = subprocess.check_output(["/sbin/ldconfig", "-p"], universal_newlines=True)
+            except (OSError, subprocess.CalledProcessError):
+                lines = ""
             for line in lines.split("\n"):
                 fields = line.split()
                 if fields and fields[0].startswith("libclang.so"):
-                    SipGenerator._libclang = fields[-1]
+                    candidates.add(fields[-1])
+        if not candidates:
+            return None
+        return max(sorted(candidates), key=SipGenerator._libclang_version)
+
+    @staticmethod
+    def _find_libclang(libclang=None):
+        """"
+        Find the libclang.so to alow us to initialise the system.
+
+        In order of preference, use the given library, $SIP_GENERATOR_LIBCLANG, the location found by a previous
+        run, or a search.
+
+        :param libclang:            Optional explicit library to use.
+        """
+        libclang = libclang or os.environ.get("SIP_GENERATOR_LIBCLANG")
+        if libclang:
+            SipGenerator._libclang = libclang
+        if not SipGenerator._libclang:
+            cache_file = SipGenerator._libclang_cache_file()
+            try:
+                with open(cache_file, "r") as f:
+                    cached = json.load(f)
+                if cached["stamp"] == SipGenerator._libclang_stamp(cached["path"]):
+                    SipGenerator._libclang = cached["path"]
+            except (IOError, OSError, ValueError, KeyError, TypeError):
+                pass
+            if not SipGenerator._libclang:
+                SipGenerator._libclang = SipGenerator._search_libclang()
+                if SipGenerator._libclang:
                     logger.debug(_("Found libclang at {}").format(SipGenerator._libclang))
+                    cached = {"path": SipGenerator._libclang,
+                              "stamp": SipGenerator._libclang_stamp(SipGenerator._libclang)}
+                    try:
+                        if not os.path.isdir(os.path.dirname(cache_file)):
+                            os.makedirs(os.path.dirname(cache_file))
+                        with open(cache_file, "w") as f:
+                            json.dump(cached, f)
+                    except (IOError, OSError):
+                        #
+                        # Not fatal, we will just search again next time.
+                        #
+                        pass
         if SipGenerator._libclang:
             if not cindex.Config.loaded:
                 cindex.Config.set_library_file(SipGenerator._libclang)
         else:
             raise RuntimeError(_("Cannot find libclang"))
 
-    @staticmethod
-    def _report_ignoring(parent, child, text=None):
+    def _report_ignoring(self, parent, child, text=None):
+        if not self.debug:
+            return
         if not text:
             text = child.displayname or child.spelling
         logger.debug(_("Ignoring {} {} child {}").format(parent.kind.name, parent.spelling, SipGenerator.describe(child, text)))
 
 
+class Profile(object):
+    """
+    Where the time goes, for --profile.
+
+    Attaching a profile to a generator wraps its methods, and turns on the timing of its rules, so that there is no
+    cost unless a profile is in use. The time of each phase is totalled, along with that of each rule database, and
+    the slowest declarations and rules are kept. The time of a declaration includes that of any nested declarations,
+    and the walk includes the rules and default values. Profiles from worker processes are merged using data() and
+    merge().
+    """
+    #
+    # The generator methods which handle a declaration, and the position of the declaration in their arguments.
+    #
+    DECLARATION_METHODS = [("_fn_get", 1), ("_typedef_get", 1), ("_var_get", 1), ("_unexposed_get", 1),
+                           ("_enum_get", 1)]
+
+    def __init__(self, top=20, pstats_dir=None):
+        """
+        Constructor.
+
+        :param top:                 The number of slowest declarations and rules to keep.
+        :param pstats_dir:          Optional directory to write a cProfile dump of each header to.
+        """
+        self.top = top
+        self.pstats_dir = pstats_dir
+        self.header = None
+        self.reset()
+
+    def reset(self):
+        self.headers = 0
+        self.phases = {}
+        self.rule_dbs = {}
+        self.rules = {}
+        self.declarations = []
+
+    def add(self, phase, seconds, calls=1):
+        totals = self.phases.setdefault(phase, [0, 0.0])
+        totals[0] += calls
+        totals[1] += seconds
+
+    def _add_declaration(self, seconds, header, declaration):
+        item = (seconds, header, declaration)
+        if len(self.declarations) < self.top:
+            heapq.heappush(self.declarations, item)
+        elif item > self.declarations[0]:
+            heapq.heapreplace(self.declarations, item)
+
+    def attach(self, generator):
+        """
+        Instrument a generator.
+
+        :param generator:           The SipGenerator.
+        """
+        profile = self
+
+        def phase(name, method):
+            def timed(*args, **kwargs):
+                start = timer()
+                try:
+                    return method(*args, **kwargs)
+                finally:
+                    profile.add(name, timer() - start)
+            return timed
+
+        def declaration(method, position):
+            def timed(*args, **kwargs):
+                start = timer()
+                try:
+                    return method(*args, **kwargs)
+                finally:
+                    profile._add_declaration(timer() - start, profile.header,
+                                             SipGenerator.describe(args[position]))
+            return timed
+
+        def container(method):
+            timed_declaration = declaration(method, 0)
+            timed_walk = phase("walk", method)
+
+            def timed(container, level, *args, **kwargs):
+                if level < 0:
+                    return timed_walk(container, level, *args, **kwargs)
+                return timed_declaration(container, level, *args, **kwargs)
+            return timed
+
+        def header(method):
+            def profiled(h_file, include_filename):
+                profile.header = h_file
+                profile.headers += 1
+                if not profile.pstats_dir:
+                    return method(h_file, include_filename)
+                profiler = cProfile.Profile()
+                try:
+                    return profiler.runcall(method, h_file, include_filename)
+                finally:
+                    profiler.dump_stats(os.path.join(profile.pstats_dir, os.path.basename(h_file) + ".pstats"))
+            return profiled
+
+        generator.create_sip = header(generator.create_sip)
+        generator.parse = phase("parse", generator.parse)
+        generator._container_get = container(generator._container_get)
+        for name, position in Profile.DECLARATION_METHODS:
+            setattr(generator, name, declaration(getattr(generator, name), position))
+        generator._fn_get_parameter_default = phase("defaults", generator._fn_get_parameter_default)
+        generator.rules.enable_timing()
+        generator.profile = self
+
+    def collect(self, rules):
+        """
+        Move the timing of the rules into the profile.
+
+        :param rules:               The RuleSet of the generator the profile is attached to.
+        """
+        for db, (calls, seconds, rule_times) in rules.get_timing().items():
+            totals = self.rule_dbs.setdefault(db, [0, 0.0])
+            totals[0] += calls
+            totals[1] += seconds
+            self.add("rules", seconds, calls)
+            for rule, usage, seconds in rule_times:
+                if usage:
+                    totals = self.rules.setdefault((db, rule), [0, 0.0])
+                    totals[0] += usage
+                    totals[1] += seconds
+
+    def data(self, top=None):
+        """
+        The profile, as JSON-compatible data.
+
+        :param top:                 Optional number of slowest rules to keep. By default, every rule which was used is
+                                    kept, so that merging the profiles of several workers ranks the rules correctly.
+        """
+        top_rules = sorted(self.rules.items(), key=lambda item: item[1][1], reverse=True)[:top]
+        return {
+            "headers": self.headers,
+            "phases": dict((k, {"calls": v[0], "seconds": v[1]}) for k, v in self.phases.items()),
+            "rule_dbs": dict((k, {"calls": v[0], "seconds": v[1]}) for k, v in self.rule_dbs.items()),
+            "slowest_declarations": [{"seconds": d[0], "header": d[1], "declaration": d[2]}
+                                     for d in sorted(self.declarations, reverse=True)],
+            "slowest_rules": [{"db": k[0], "rule": k[1], "usage": v[0], "seconds": v[1]} for k, v in top_rules],
+        }
+
+    def merge(self, data):
+        """
+        Add in a profile as returned by data().
+        """
+        self.headers += data["headers"]
+        for k, v in data["phases"].items():
+            self.add(k, v["seconds"], v["calls"])
+        for k, v in data["rule_dbs"].items():
+            totals = self.rule_dbs.setdefault(k, [0, 0.0])
+            totals[0] += v["calls"]
+            totals[1] += v["seconds"]
+        for d in data["slowest_declarations"]:
+            self._add_declaration(d["seconds"], d["header"], d["declaration"])
+        for r in data["slowest_rules"]:
+            totals = self.rules.setdefault((r["db"], r["rule"]), [0, 0.0])
+            totals[0] += r["usage"]
+            totals[1] += r["seconds"]
+
+    def write(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.data(self.top), f, indent=4, sort_keys=True)
+
+
+class OutputCache(object):
+    """
+    A content-addressed cache of generated SIP files, shared across runs and build directories.
+
+    Entries are looked up in two steps. The header's path and the generator fingerprint locate a manifest listing the
+    files the header read last time it was processed. The contents of those files then give the key of the SIP output.
+    A change to the header, anything it includes, the rules, the generator or the compiler flags therefore results in
+    a miss. Entries are evicted least recently used first when the cache grows beyond its maximum size.
+    """
+    def __init__(self, cache_dir, max_size, fingerprint):
+        """
+        Constructor.
+
+        :param cache_dir:           The cache directory.
+        :param max_size:            The maximum size of the cache in bytes.
+        :param fingerprint:         The SipGenerator.fingerprint().
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.fingerprint = fingerprint
+        self.digests = {}
+        for subdir in ["manifests", "sip"]:
+            path = os.path.join(cache_dir, subdir)
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    #
+                    # Someone else got there first?
+                    #
+                    if not os.path.isdir(path):
+                        raise
+
+    def _digest(self, filename):
+        """
+        Hash a file's contents, remembering the result for as long as the file is unchanged.
+        """
+        st = os.stat(filename)
+        stamp = (st.st_mtime, st.st_size)
+        cached = self.digests.get(filename)
+        if cached and cached[0] == stamp:
+            return cached[1]
+        hasher = hashlib.sha1()
+        with open(filename, "rb") as f:
+            hasher.update(f.read())
+        digest = hasher.hexdigest()
+        self.digests[filename] = (stamp, digest)
+        return digest
+
+    def _base_key(self, h_file, include_filename):
+        key = "\0".join([self.fingerprint, os.path.abspath(h_file), include_filename or ""])
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def _key(self, base, deps):
+        hasher = hashlib.sha1(base.encode("utf-8"))
+        for dep in deps:
+            hasher.update("\0{}\0{}".format(dep, self._digest(dep)).encode("utf-8"))
+        return hasher.hexdigest()
+
+    def _path(self, subdir, key, suffix):
+        return os.path.join(self.cache_dir, subdir, key + suffix)
+
+    def _write(self, path, write_fn):
+        """
+        Write atomically so that concurrent readers never see a partial entry.
+        """
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "w") as f:
+                write_fn(f)
+            os.rename(tmp, path)
+        except Exception:
+            os.remove(tmp)
+            raise
+
+    def fetch(self, h_file, include_filename, sip_file):
+        """
+        Copy the cached output for a header, if there is one.
+
+        :return:                    The files read to generate the output on a hit, otherwise None.
+        """
+        base = self._base_key(h_file, include_filename)
+        manifest = self._path("manifests", base, ".json")
+        try:
+            with open(manifest, "r") as f:
+                deps = json.load(f)
+            cached = self._path("sip", self._key(base, deps), ".sip")
+            shutil.copyfile(cached, sip_file)
+        except (IOError, OSError, ValueError):
+            #
+            # No manifest, a dependency has gone, or there is no cached output.
+            #
+            return None
+        #
+        # Keep track of recent use for eviction. The manifest is needed to find the output, so touch it last to keep
+        # it from being evicted first.
+        #
+        try:
+            os.utime(cached, None)
+            os.utime(manifest, None)
+        except OSError:
+            #
+            # Evicted by a concurrent run. We already have the output.
+            #
+            pass
+        logger.debug(_("Cache hit for {}").format(h_file))
+        return deps
+
+    def store(self, h_file, include_filename, deps, sip_file):
+        """
+        Add the output for a header to the cache.
+
+        :param deps:                All the files read to generate the output.
+        """
+        base = self._base_key(h_file, include_filename)
+        with open(sip_file, "r") as src:
+            body = src.read()
+        #
+        # Write the manifest last, as for fetch().
+        #
+        self._write(self._path("sip", self._key(base, deps), ".sip"), lambda f: f.write(body))
+        self._write(self._path("manifests", base, ".json"), lambda f: json.dump(deps, f))
+
+    def trim(self):
+        """
+        Evict the least recently used entries until the cache fits its maximum size.
+        """
+        entries = []
+        total = 0
+        #
+        # Where the timestamps are too coarse to tell an output and its manifest apart, evict the output first.
+        #
+        for order, subdir in enumerate(["sip", "manifests", ""]):
+            path = os.path.join(self.cache_dir, subdir)
+            for name in os.listdir(path):
+                #
+                # At the top level, only the include trees are ours to evict.
+                #
+                if not subdir and not fnmatch.fnmatch(name, "includes-*.json"):
+                    continue
+                filename = os.path.join(path, name)
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, order, st.st_size, filename))
+                total += st.st_size
+        for mtime, order, size, filename in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            total -= size
+        logger.debug(_("Cache is {} bytes").format(total))
+
+
+def generate_sip(generator, h_file, include_filename, sip_file):
+    """
+    Generate one SIP file, or copy it from the generator's output cache if there is one.
+
+    :param generator:           The SipGenerator.
+    :param h_file:              The source (header) file of interest.
+    :param include_filename:    The (header) to generate in the sip file.
+    :param sip_file:            The output SIP file.
+    :return:                    The files read to generate the output.
+    """
+    cache = generator.cache
+    if cache:
+        deps = cache.fetch(h_file, include_filename, sip_file)
+        if deps is not None:
+            return deps
+    body, includes = generator.create_sip(h_file, include_filename)
+    start = timer()
+    write_sip(sip_file, body)
+    if generator.profile:
+        generator.profile.add("emit", timer() - start)
+    deps = generator.dependencies()
+    if cache:
+        cache.store(h_file, include_filename, deps, sip_file)
+    return deps
+
+
+def read_manifest(manifest):
+    """
+    Read a batch manifest. Each non-blank line contains three ";"-separated fields, as written by
+    ecm_generate_python_binding:
+
+        <C++ header>;<header include filename>;<output SIP file>
+
+    :param manifest:            The manifest file.
+    :return:                    A list of (h_file, include_filename, sip_file) tuples.
+    """
+    entries = []
+    with open(manifest, "r") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            fields = line.split(";")
+            if len(fields) != 3:
+                raise RuntimeError(_("Bad manifest entry {}:{}: '{}'").format(manifest, line_number, line))
+            entries.append(tuple(fields))
+    return entries
+
+
+def write_sip(sip_file, body):
+    """
+    Write a generated SIP file. The content matches what the single-header mode prints.
+
+    :param sip_file:            The output SIP file.
+    :param body:                The generated SIP text, as a list of fragments from create_sip().
+    """
+    with open(sip_file, "w") as f:
+        if body:
+            f.writelines(rules_engine.iter_fragments(body))
+            f.write("\n")
+
+
+def write_depfile(depfile, targets, deps):
+    """
+    Write a Makefile-style depfile, as read by make, ninja and CMake's DEPFILE.
+
+    :param depfile:             The depfile.
+    :param targets:             The files generated, named as the build tool knows them.
+    :param deps:                The files they were generated from.
+    """
+    def escape(filename):
+        return filename.replace(" ", "\\ ").replace("#", "\\#").replace("$", "$$")
+
+    with open(depfile, "w") as f:
+        f.write(" ".join(escape(t) for t in targets) + ":")
+        for dep in deps:
+            f.write(" \\\n  " + escape(os.path.abspath(dep)))
+        f.write("\n")
+
+
+def generate_batch(generator, entries, errors=None, dependencies=None):
+    """
+    Generate a whole list of SIP files using one SipGenerator, so that the libclang setup, the compiled rules and
+    the include directories are shared across all the headers.
+
+    :param generator:           The SipGenerator.
+    :param entries:             A list of (h_file, include_filename, sip_file) tuples.
+    :param errors:              Optional list to add the error for each failure to, rather than logging it.
+    :param dependencies:        Optional dict to record the files read to generate each SIP file in.
+    :return:                    The number of headers which could not be processed.
+    """
+    failures = 0
+    for h_file, include_filename, sip_file in entries:
+        logger.debug(_("Processing {} into {}").format(h_file, sip_file))
+        try:
+            deps = generate_sip(generator, h_file, include_filename, sip_file)
+            if dependencies is not None:
+                dependencies[sip_file] = deps
+        except Exception as e:
+            error = _("Failed to process {}: {}").format(h_file, traceback.format_exc())
+            if errors is None:
+                logger.error(error)
+            else:
+                errors.append(error)
+            #
+            # Do not leave a partial file behind to confuse the build system.
+            #
+            if os.path.exists(sip_file):
+                os.remove(sip_file)
+            failures += 1
+    return failures
+
+
+#
+# The generator used by worker processes. It is set up before the pool of workers is forked so that each worker
+# inherits the already loaded rules and resolved includes.
+#
+_worker_generator = None
+
+
+def _worker_init():
+    #
+    # Each worker needs its own libclang index.
+    #
+    _worker_generator.index = None
+
+
+def _worker_create_sip(entry):
+    """
+    Generate one SIP file in a worker process.
+
+    :param entry:               A (h_file, include_filename, sip_file) tuple.
+    :return:                    The entry, any error text, the rule usage counts, the files read and any profile
+                                    data for this entry.
+    """
+    h_file, include_filename, sip_file = entry
+    rules = _worker_generator.rules
+    rules.reset_usage()
+    profile = _worker_generator.profile
+    if profile:
+        profile.reset()
+    error = None
+    deps = None
+    try:
+        deps = generate_sip(_worker_generator, h_file, include_filename, sip_file)
+    except Exception as e:
+        error = traceback.format_exc()
+        if os.path.exists(sip_file):
+            os.remove(sip_file)
+    usage = rules.get_usage()
+    if profile:
+        profile.collect(rules)
+        profile = profile.data()
+    return entry, error, usage, deps, profile
+
+
+def generate_parallel(generator, entries, jobs, errors=None, dependencies=None):
+    """
+    Generate a list of SIP files using a pool of worker processes. Each header is written to its own SIP file, and
+    the rule usage counts from the workers are merged back into the rules of the given generator.
+
+    :param generator:           The SipGenerator, shared with the workers.
+    :param entries:             A list of (h_file, include_filename, sip_file) tuples.
+    :param jobs:                The number of worker processes.
+    :param errors:              Optional list to add the error for each failure to, rather than logging it.
+    :param dependencies:        Optional dict to record the files read to generate each SIP file in.
+    :return:                    The number of headers which could not be processed.
+    """
+    global _worker_generator
+    #
+    # Share the precompiled prelude, if any, rather than each worker building it.
+    #
+    generator.prepare_pch()
+    _worker_generator = generator
+    failures = 0
+    #
+    # The workers inherit the generator, which holds libclang objects that cannot be pickled, so they must be forked
+    # whatever the platform's default start method. Python 2 always forks.
+    #
+    context = multiprocessing.get_context("fork") if hasattr(multiprocessing, "get_context") else multiprocessing
+    pool = context.Pool(jobs, _worker_init)
+    try:
+        for (h_file, include_filename, sip_file), error, usage, deps, profile in pool.imap(_worker_create_sip,
+                                                                                             entries):
+            generator.rules.add_usage(usage)
+            if profile:
+                generator.profile.merge(profile)
+            if dependencies is not None and deps is not None:
+                dependencies[sip_file] = deps
+            if error:
+                error = _("Failed to process {}: {}").format(h_file, error)
+                if errors is None:
+                    logger.error(error)
+                else:
+                    errors.append(error)
+                failures += 1
+    finally:
+        pool.close()
+        pool.join()
+        _worker_generator = None
+    return failures
+
+
+def _read_line(connection):
+    """
+    Read a newline-terminated message from a socket.
+    """
+    chunks = []
+    while True:
+        chunk = connection.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        if chunk.endswith(b"\n"):
+            break
+    return b"".join(chunks).decode("utf-8")
+
+
+class GeneratorServer(object):
+    """
+    A persistent generator process, which keeps libclang, the compiled rules, the include directories and any
+    preambles warm between requests from clients on a Unix domain socket.
+
+    Each request is one line of JSON, {"entries": [[h_file, include_filename, sip_file], ...]}, and is answered by
+    one line of JSON, {"status": 0 or -1, "errors": [...]}. The server exits after being idle for a while, and
+    reloads the rules whenever the rules file changes.
+    """
+    def __init__(self, socket_path, generator, make_rules, rules_file=None, jobs=1, idle_timeout=600):
+        """
+        Constructor.
+
+        :param socket_path:         The Unix domain socket to listen on.
+        :param generator:           The SipGenerator.
+        :param make_rules:          Callable to load the rules afresh.
+        :param rules_file:          Optional rules file to watch for changes.
+        :param jobs:                The number of worker processes for requests with several entries.
+        :param idle_timeout:        Seconds without a request before exiting.
+        """
+        self.socket_path = socket_path
+        self.generator = generator
+        self.make_rules = make_rules
+        self.rules_file = rules_file
+        self.rules_stamp = self._rules_stamp()
+        self.jobs = jobs
+        self.idle_timeout = idle_timeout
+
+    def _rules_stamp(self):
+        if not self.rules_file:
+            return None
+        try:
+            st = os.stat(self.rules_file)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
+    def _reload_rules(self):
+        """
+        Reload the rules if the rules file has changed since they were loaded.
+        """
+        stamp = self._rules_stamp()
+        if stamp == self.rules_stamp:
+            return
+        logger.info(_("Reloading rules from {}").format(self.rules_file))
+        self.generator.rules = self.make_rules()
+        if self.generator.cache:
+            self.generator.cache.fingerprint = self.generator.fingerprint()
+        self.rules_stamp = stamp
+
+    def _listen(self):
+        if os.path.exists(self.socket_path):
+            #
+            # Is there a live server, or just the socket from one which did not exit cleanly?
+            #
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+            except socket.error:
+                os.remove(self.socket_path)
+            else:
+                raise RuntimeError(_("A generator is already listening on {}").format(self.socket_path))
+            finally:
+                probe.close()
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.socket_path)
+        listener.listen(5)
+        listener.settimeout(self.idle_timeout)
+        return listener
+
+    def serve(self):
+        """
+        Handle requests until the server has been idle for the timeout.
+        """
+        listener = self._listen()
+        logger.info(_("Listening on {}").format(self.socket_path))
+        try:
+            while True:
+                try:
+                    connection, address = listener.accept()
+                except socket.timeout:
+                    logger.info(_("Idle for {}s, exiting").format(self.idle_timeout))
+                    break
+                try:
+                    connection.settimeout(self.idle_timeout)
+                    self._handle(connection)
+                except Exception as e:
+                    logger.error(_("Failed to handle request: {}").format(traceback.format_exc()))
+                finally:
+                    connection.close()
+        finally:
+            listener.close()
+            os.remove(self.socket_path)
+
+    def _handle(self, connection):
+        request = json.loads(_read_line(connection))
+        #
+        # Python 2's json gives unicode, but manifests give str. The include filename may be missing.
+        #
+        entries = [tuple(f if f is None or isinstance(f, str) else f.encode("utf-8") for f in entry)
+                   for entry in request["entries"]]
+        errors = []
+        try:
+            self._reload_rules()
+            if self.jobs > 1 and len(entries) > 1:
+                generate_parallel(self.generator, entries, min(self.jobs, len(entries)), errors)
+            else:
+                generate_batch(self.generator, entries, errors)
+            if self.generator.cache:
+                self.generator.cache.trim()
+        except Exception as e:
+            errors.append(traceback.format_exc())
+        reply = {"status": -1 if errors else 0, "errors": errors}
+        connection.sendall((json.dumps(reply) + "\n").encode("utf-8"))
+
+
+def request_server(socket_path, entries):
+    """
+    Have a GeneratorServer generate a list of SIP files.
+
+    :param socket_path:         The Unix domain socket the server is listening on.
+    :param entries:             A list of (h_file, include_filename, sip_file) tuples.
+    :return:                    The server's status.
+    """
+    #
+    # The server need not share our working directory.
+    #
+    entries = [(os.path.abspath(h_file), include_filename, os.path.abspath(sip_file))
+               for h_file, include_filename, sip_file in entries]
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            client.connect(socket_path)
+        except socket.error as e:
+            raise RuntimeError(_("No generator is listening on {}: {}").format(socket_path, e))
+        client.sendall((json.dumps({"entries": entries}) + "\n").encode("utf-8"))
+        reply = _read_line(client)
+    finally:
+        client.close()
+    if not reply:
+        raise RuntimeError(_("No reply from the generator on {}").format(socket_path))
+    reply = json.loads(reply)
+    for error in reply["errors"]:
+        logger.error(error)
+    return reply["status"]
+
+
 def main(argv=None):
     """
     Take a single C++ header file and generate the corresponding SIP file.
@@ -904,9 +2211,21 @@ def main(argv=None):
     header file, a set of rules can be used to customise the generated
     SIP file.
 
+    In batch mode, a manifest lists many headers which are all processed
+    in a single run, each one being written to its own SIP file.
+
     Examples:
 
         sip_generator.py /usr/include/KF5/KItemModels/kselectionproxymodel.h
+        sip_generator.py --batch KItemModels.manifest
+        sip_generator.py -j 8 --batch KItemModels.manifest
+
+    A server keeps a warm generator for clients to use, and exits when it
+    has been idle for --idle-timeout seconds:
+
+        sip_generator.py --preamble --serve build/sip_generator.sock &
+        sip_generator.py --connect build/sip_generator.sock --include_filename kselectionproxymodel.h \\
+            --output kselectionproxymodel.sip /usr/include/KF5/KItemModels/kselectionproxymodel.h
     """
     if argv is None:
         argv = sys.argv
@@ -916,25 +2235,164 @@ def main(argv=None):
     parser.add_argument("--includes",
                         help=_("Comma-separated C++ header directories to use"))
     parser.add_argument("--project-rules", help=_("Project rules"))
+    parser.add_argument("--libclang",
+                        help=_("The libclang library to use, rather than searching for it"))
     parser.add_argument("--include_filename", help=_("C++ header include to compile"))
-    parser.add_argument("source", help=_("C++ header to process"))
+    parser.add_argument("--batch", metavar="MANIFEST",
+                        help=_("Process all the (header, include filename, SIP file) entries in the manifest"))
+    parser.add_argument("-j", "--jobs", type=int, default=1, help=_("Number of worker processes in batch mode"))
+    parser.add_argument("--pch-prelude",
+                        help=_("Comma-separated C++ headers to precompile once and reuse for every header"))
+    parser.add_argument("--pch-file", help=_("Precompiled prelude to write, required with --pch-prelude"))
+    parser.add_argument("--preamble", action="store_true", default=False,
+                        help=_("Reuse libclang's precompiled preamble when a header is processed repeatedly"))
+    parser.add_argument("--cache-dir", default=os.environ.get("SIP_GENERATOR_CACHE_DIR"),
+                        help=_("Directory for caching the include directories, and generated SIP files in batch mode"))
+    parser.add_argument("--cache-size", type=int, default=500, help=_("Maximum size of the cache in MB"))
+    parser.add_argument("--snapshot-dir", default=os.environ.get("SIP_GENERATOR_SNAPSHOT_DIR"),
+                        help=_("Directory for snapshots of the parsed headers, which are used instead of parsing "
+                               "unchanged headers again. Rules are then passed a reduced version "
+                               "of the clang.cindex API, see RuleSet"))
+    parser.add_argument("--minimal-includes", action="store_true", default=False,
+                        help=_("Only use the include directories each header needs"))
+    parser.add_argument("--dump-rule-usage", action="store_true", default=False,
+                        help=_("Report the usage of each rule when done"))
+    parser.add_argument("--trace-rule", metavar="PATTERN", action="append",
+                        help=_("Log what the matching rule functions or rule databases do, without tracing every "
+                               "rule as --verbose does, and warn when they change nothing. Other rules are only "
+                               "checked for changing nothing with --verbose. May be repeated"))
+    parser.add_argument("--profile", metavar="FILE", help=_("Write a JSON profile of where the time went to FILE"))
+    parser.add_argument("--profile-top", type=int, default=20,
+                        help=_("Number of slowest declarations and rules to profile"))
+    parser.add_argument("--profile-pstats", metavar="DIR", help=_("Also write a cProfile dump of each header to DIR"))
+    parser.add_argument("-o", "--output", help=_("SIP file to write, rather than writing to stdout"))
+    parser.add_argument("--depfile",
+                        help=_("Write a Makefile-style depfile listing the headers read. In batch mode, its target is "
+                               "the first SIP file"))
+    parser.add_argument("--depfile-target",
+                        help=_("Name the target of the depfile like this, rather than by its absolute path, for "
+                               "build tools which need it named as in their own build files"))
+    parser.add_argument("--serve", metavar="SOCKET", help=_("Serve requests from clients on a Unix domain socket"))
+    parser.add_argument("--idle-timeout", type=int, default=600,
+                        help=_("Seconds without a request before the server exits"))
+    parser.add_argument("--connect", metavar="SOCKET",
+                        help=_("Have the server on the socket process the source or --batch manifest"))
+    parser.add_argument("source", nargs="?", help=_("C++ header to process"))
     try:
         args = parser.parse_args(argv[1:])
+        if not args.batch and not args.source and not args.serve:
+            parser.error(_("One of --batch, --serve or source is required"))
+        if args.connect and args.source and not args.output:
+            parser.error(_("--connect with a source requires --output"))
+        if args.depfile and not args.batch and not args.output:
+            parser.error(_("--depfile requires --batch or --output"))
+        if args.depfile_target and not args.depfile:
+            parser.error(_("--depfile-target requires --depfile"))
+        if args.pch_prelude and not args.pch_file:
+            parser.error(_("--pch-prelude requires --pch-file"))
+        if args.profile and (args.serve or args.connect):
+            parser.error(_("--profile cannot be used with --serve or --connect"))
+        if args.profile_pstats and not args.profile:
+            parser.error(_("--profile-pstats requires --profile"))
         if args.verbose:
             logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(name)s %(levelname)s: %(message)s')
         else:
             logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+        if args.trace_rule:
+            rules_engine.trace_logger.setLevel(logging.DEBUG)
+        if args.connect:
+            if args.batch:
+                entries = read_manifest(args.batch)
+            else:
+                entries = [(args.source, args.include_filename, args.output)]
+            return request_server(args.connect, entries)
         #
         # Generate!
         #
-        if (args.project_rules):
-            rules = rules_engine.rules(args.project_rules, args.includes)
+        def make_rules():
+            if (args.project_rules):
+                #
+                # The compiled rules file is keyed by its content, so either cache will do to keep it in.
+                #
+                rules = rules_engine.rules(args.project_rules, args.includes, args.cache_dir or args.snapshot_dir)
+            else:
+                rules = rules_engine.Qt5Rules(args.includes)
+            if args.trace_rule:
+                rules.set_tracing(args.trace_rule)
+            return rules
+
+        for directory in [args.cache_dir, args.snapshot_dir, args.profile_pstats]:
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+        rules = make_rules()
+        pch_prelude = None
+        if args.pch_prelude:
+            pch_prelude = [i.strip() for i in args.pch_prelude.split(",") if i.strip()]
+        g = SipGenerator(rules, args.verbose, pch_prelude=pch_prelude, pch_file=args.pch_file,
+                         preamble=args.preamble, include_cache=args.cache_dir,
+                         minimal_includes=args.minimal_includes, libclang=args.libclang,
+                         snapshot_dir=args.snapshot_dir)
+        if args.profile:
+            Profile(args.profile_top, args.profile_pstats).attach(g)
+        if args.serve:
+            g.check_snapshots(None)
+            if args.cache_dir:
+                g.cache = OutputCache(args.cache_dir, args.cache_size * 1024 * 1024, g.fingerprint())
+            GeneratorServer(args.serve, g, make_rules, args.project_rules, args.jobs, args.idle_timeout).serve()
+        elif args.batch:
+            #
+            # Cache hits skip the rules, so do not use the cache when we need to account for rule usage or time.
+            #
+            if args.cache_dir and not args.dump_rule_usage and not args.profile:
+                g.cache = OutputCache(args.cache_dir, args.cache_size * 1024 * 1024, g.fingerprint())
+            entries = read_manifest(args.batch)
+            g.check_snapshots([source for source, include_filename, sip_file in entries])
+            dependencies = {} if args.depfile else None
+            if args.jobs > 1 and len(entries) > 1:
+                failures = generate_parallel(g, entries, min(args.jobs, len(entries)), dependencies=dependencies)
+            else:
+                failures = generate_batch(g, entries, dependencies=dependencies)
+                #
+                # The profiles of any workers already include their rules.
+                #
+                if g.profile:
+                    g.profile.collect(rules)
+            if args.depfile and entries:
+                #
+                # The depfile for the whole run names only the first SIP file: older versions of ninja reject
+                # depfiles with more than one target, and the dependencies apply to the whole run anyway.
+                #
+                deps = set()
+                for dep in dependencies.values():
+                    deps.update(dep)
+                write_depfile(args.depfile, [args.depfile_target or os.path.abspath(entries[0][2])], sorted(deps))
+            if g.cache:
+                g.cache.trim()
+            if args.dump_rule_usage:
+                rules.dump_unused()
+            if g.profile:
+                g.profile.write(args.profile)
+            if failures:
+                return -1
         else:
-            rules = rules_engine.Qt5Rules(args.includes)
-        g = SipGenerator(rules, args.verbose)
-        body, includes = g.create_sip(args.source, args.include_filename)
-        if body:
-            print(body)
+            g.check_snapshots([args.source])
+            body, includes = g.create_sip(args.source, args.include_filename)
+            if args.output:
+                start = timer()
+                write_sip(args.output, body)
+                if g.profile:
+                    g.profile.add("emit", timer() - start)
+                if args.depfile:
+                    write_depfile(args.depfile, [args.depfile_target or os.path.abspath(args.output)],
+                                  g.dependencies())
+            elif body:
+                sys.stdout.writelines(rules_engine.iter_fragments(body))
+                sys.stdout.write("\n")
+            if args.dump_rule_usage:
+                rules.dump_unused()
+            if g.profile:
+                g.profile.collect(rules)
+                g.profile.write(args.profile)
     except Exception as e:
         tbk = traceback.format_exc()
         print(tbk)